@@ -2,22 +2,50 @@
 # These imports are built into Python
 import os
 import sys
+# Time the rest of the imports when asked to (see startup_profile)
+import startup_profile
+if any(arg.startswith('--profile-startup') for arg in sys.argv[1:]):
+    startup_profile.enable()
 import time
 import tkinter as tk
 from tkinter import ttk
 import tkinter.simpledialog
 import configparser
-import traceback
+import threading
+import multiprocessing
 from glob import glob
 from collections import OrderedDict
 from importlib import import_module
 import queue as Queue
+import triggers
+import error_log
+from pipeline import Pipeline
+from operator_prompt import OperatorRequest
+
+def get_option(name, default = None):
+    '''Returns the value of --name=value (or True for --name) from the 
+    command line, or default when it wasn't given.'''
+    for arg in sys.argv[1:]:
+        if arg == '--' + name:
+            return True
+        if arg.startswith('--%s='%name):
+            return arg.split('=', 1)[1]
+    return default
+
+# Command line options:
+#   --lazy  Only load the procedures (and the equipment drivers they use) 
+#       and the part images when they are first needed, so that the window
+#       appears sooner
+#   --profile-startup[=filename]  Write an import and init timeline once the
+#       window is shown (see startup_profile)
+lazy_loading = bool(get_option('lazy', False))
 
 # These imports are not built into Python:
 try:
     import release
     version = release.version
 except ImportError:
+    release = None
     version = 'INVALID RELEASE'
 
 version_tuple = (f'Commissioning Station {version}', f'调试站 {version}')
@@ -40,8 +68,14 @@ langDict = {'lang':('english', 'chinese'),
             'testframe':('Test Details','测试细节'),
             'commission':('Commission Product','佣金产品'),
             'continue':('Continue','继续'),
+            'stop':('Stop','停止'),
+            'fixture':('Fixture %s','夹具 %s'),
             }
 
+# Station level configuration (number of fixtures and the equipment bound to
+# each fixture). The station runs a single fixture when this file is missing.
+station_config_file = 'station.ini'
+
 class Translatable(tk.StringVar):
     '''A StringVar container that holds a translatable string. The language
     is based on the index of the translations tuple/list.'''
@@ -153,16 +187,27 @@ class TestWidget(VarLabelFrame):
                     stringvar = self.translatables['testframe'])
 
         self.row = 0
-        # Add a manual go button at the top of the list (this may be replaced 
-        # by the box open / box closed signal)
-        self.runBtn = ttk.Button(self, command = self.test_running,
+        controls = ttk.Frame(self)
+        controls.grid(row = self.row, column = 0, sticky = tk.W)
+        # Add a manual go button at the top of the list (the part number's
+        # [trigger], if any, starts the tests without it)
+        self.runBtn = ttk.Button(controls, command = self.test_running,
                                 textvariable = self.translatables['commission'])
-        self.runBtn.grid(row = self.row, column = 0, sticky = tk.W)
-        # Simple indeterminate progress bar to show the user that the
-        # program has not locked up
+        self.runBtn.grid(row = 0, column = 0, sticky = tk.W)
+        # Stop this fixture without affecting the other fixtures (the 
+        # running test finishes, the rest are skipped)
+        self.stopBtn = ttk.Button(controls, command = self.test_stop,
+                                textvariable = self.translatables['stop'],
+                                state = 'disabled')
+        self.stopBtn.grid(row = 0, column = 1, sticky = tk.W)
+        # Progress bar showing the elapsed part of the expected run time
+        # (learned from earlier runs), or just that the program has not 
+        # locked up when there is no estimate yet
         self.progress = ttk.Progressbar(self, orient = 'horizontal', 
                                         length = 300, mode = 'indeterminate')
         self.progress.grid(row = self.row, column = 1)
+        self.progress_job = None
+        self.progress_start = None
         self.row += 1
         # Add a separator do split tests from controls
         sep = ttk.Separator(self)
@@ -173,23 +218,47 @@ class TestWidget(VarLabelFrame):
         # by the procedure
         self.test_widgets = {}
 
-        # Queue to hold updates to tests
+        # Queue to hold updates to tests. Worker threads post to the queue
+        # and wake the Tk loop only when the queue goes from empty to
+        # non-empty, so nothing runs while no job is active.
         self.testUpdateQueue = Queue.Queue()
-        # Start looking for posted GUI updates
-        self.after(10, self.update_check)
+        self.update_lock = threading.Lock()
+        self.update_pending = False
+
+        # Starts the tests when a DUT is put in the fixture (see triggers)
+        self.trigger = None
+        self.running = False
+        # Runs consecutive DUTs through the procedure's stages at the same 
+        # time when the part number sets [pipeline] depth (see pipeline),
+        # started by the job's first DUT
+        self.pipeline = None
+        # DUTs in the pipeline
+        self.duts = 0
+
+    # Thread safe
+    def post_update(self, id, state):
+        self.testUpdateQueue.put((id, state))
+        with self.update_lock:
+            if self.update_pending:
+                return
+            self.update_pending = True
+        # Use the after method to make the call thread safe
+        self.after(0, self.update_check)
 
     def update_check(self):
-        updates = []
-        done = False
-        while not done:
+        with self.update_lock:
+            self.update_pending = False
+        # Merge bursts of updates so each test is only repainted once with
+        # its latest state
+        updates = OrderedDict()
+        while True:
             try:
-                updates.append(self.testUpdateQueue.get_nowait())
-            except:
-                done = True
-        for (id,state) in updates:
+                (id, state) = self.testUpdateQueue.get_nowait()
+            except Queue.Empty:
+                break
+            updates[id] = state
+        for (id, state) in updates.items():
             self.test_widgets[id].set_state(state)
-        # Schedule another check for updates
-        self.after(10, self.update_check)
 
     def set_config(self, config):
         self.config = config
@@ -208,7 +277,9 @@ class TestWidget(VarLabelFrame):
     def set_tests(self, tests):
         self.clear_tests()
         for n,(k,v) in enumerate(tests.items()):
-            testKey = 'test%d'%n
+            # Prefix the key with the fixture so that each fixture's tests
+            # are translated
+            testKey = '%s.test%d'%(self.parent.name, n)
             trans = Translatable(v, lang_idx = self.parent.lang_idx)
             self.translatables[testKey] = trans
             self.test_widgets[k] = TestStepWidget(self, trans)
@@ -226,43 +297,204 @@ class TestWidget(VarLabelFrame):
         self.reset_tests()
         # Display the widget
         self.grid()
+        procedure = self.parent.procedure
+        self.trigger = triggers.make_trigger(procedure.config, 
+                                            procedure.equipment)
+        if self.trigger is not None:
+            self.trigger.start(self.trigger_fired)
+        # The tests wait for a poll in progress before using the reader
+        procedure.trigger = self.trigger
         # Initialize with an open box, waiting for the box to close
         self.test_idle()
 
     def at_job_end(self):
         '''Actions to take when a job has ended.'''
+        # Stop the progress bar timer so nothing ticks while hidden
+        self.progress_stop()
+        if self.trigger is not None:
+            self.trigger.stop()
+            self.trigger = None
+            self.parent.procedure.trigger = None
+        if self.pipeline is not None:
+            # Stop the DUTs in the pipeline, and end the stages once their 
+            # running tests have finished without holding up the GUI
+            self.pipeline.stop()
+            thread = threading.Thread(target = self.pipeline.close, 
+                                    name = 'Pipeline close')
+            thread.daemon = True
+            thread.start()
+            self.pipeline = None
+            self.duts = 0
         # Hide the widget from the user
         self.grid_remove()
 
     def test_idle(self):
+        self.running = False
         self.runBtn.configure(state = 'normal')
+        self.stopBtn.configure(state = 'disabled')
+        # Wait for the next DUT (once this one has been taken out)
+        if self.trigger is not None:
+            self.trigger.arm()
         # When the box is open, we're waiting on a board
-        self.progress.stop()
+        self.progress_stop()
         self.after(20, self.progress.grid_remove)
 
-    def test_running(self):
+    def progress_begin(self, expected):
+        if expected > 0:
+            self.progress.configure(mode = 'determinate', maximum = expected,
+                                    value = 0)
+            self.progress_start = time.time()
+            self.progress_tick()
+        else:
+            self.progress.configure(mode = 'indeterminate', maximum = 100)
+            # 50 ms is smooth enough to show activity without waking the
+            # Tk loop 100 times a second
+            self.progress.start(50)
+
+    def progress_tick(self):
+        # Hold just short of full when the run takes longer than expected
+        maximum = float(self.progress.cget('maximum'))
+        elapsed = time.time() - self.progress_start
+        self.progress.configure(value = min(elapsed, 0.99*maximum))
+        self.progress_job = self.after(100, self.progress_tick)
+
+    def progress_stop(self):
+        self.progress.stop()
+        if self.progress_job is not None:
+            self.after_cancel(self.progress_job)
+            self.progress_job = None
+
+    # Now thread safe
+    def trigger_fired(self, trigger):
+        self.after(0, self._trigger_fired, trigger.value)
+
+    def _trigger_fired(self, value):
+        # The operator may have started the tests in the meantime
+        if self.pipeline is not None:
+            if self.pipeline.ready():
+                self.pipeline_feed(value)
+        elif not self.running:
+            self.test_running(value)
+
+    def pipeline_depth(self):
+        return self.parent.procedure.config.getint('pipeline', 'depth', 
+                                                    fallback = 0)
+
+    def test_running(self, trigger_value = None):
+        if self.pipeline_depth() > 0:
+            self.pipeline_feed(trigger_value)
+            return
+        self.running = True
+        if self.trigger is not None:
+            self.trigger.disarm()
         self.runBtn.configure(state = 'disabled')
         self.reset_tests()
         self.parent.clear_face()
         try:
+            expected = self.parent.procedure.get_expected_time()
+            # The EPC or barcode that started the tests (None for a click)
+            self.parent.procedure.trigger_value = trigger_value
             self.parent.procedure.test_start()
             # When the box is closed, we're waiting on a test procedure
-            self.progress.configure(mode = 'indeterminate', maximum = 100)
-            self.progress.start(10)
+            self.progress_stop()
+            self.progress_begin(expected)
             self.progress.grid()
+            self.stopBtn.configure(state = 'normal')
         except self.parent.procedure.EquipmentFailure as e:
-            msg = 'Equipment failure:\n\t%s\n\t%s'%(e.name, e.message)
+            msg = 'Equipment failure:\n\t%s'%e.message
             mb = MessageBox(self, tk.StringVar(self.parent, msg))
             self.after(0, mb.create)
             self.parent.procedure.stop()
             self.test_idle()
 
+    def test_stop(self):
+        self.stopBtn.configure(state = 'disabled')
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        else:
+            self.parent.procedure.stop()
+        # A label scanned for a DUT that was stopped must not go to the next
+        self.parent.procedure.clear_captures()
+
+    def dut_finished(self):
+        '''A DUT's run has ended.'''
+        if self.pipeline is None:
+            self.test_idle()
+            return
+        self.duts -= 1
+        if self.duts == 0:
+            self.stopBtn.configure(state = 'disabled')
+            self.progress_stop()
+            self.after(20, self.progress.grid_remove)
+
+    def pipeline_feed(self, trigger_value = None):
+        '''Starts the next DUT through the pipeline, starting the pipeline
+        (and connecting the equipment) for the job's first DUT.'''
+        if self.trigger is not None:
+            self.trigger.disarm()
+        self.runBtn.configure(state = 'disabled')
+        procedure = self.parent.procedure
+        if self.pipeline is None:
+            pipeline = Pipeline(self.parent, procedure, self.pipeline_depth())
+            pipeline.stage_callback = lambda context, n: self.stage_started(
+                                                            pipeline, n)
+            try:
+                pipeline.start()
+            except procedure.EquipmentFailure as e:
+                msg = 'Equipment failure:\n\t%s'%e.message
+                mb = MessageBox(self, tk.StringVar(self.parent, msg))
+                self.after(0, mb.create)
+                self.test_idle()
+                return
+            self.pipeline = pipeline
+            if self.trigger is not None:
+                # Poll the reader only while no stage is using it
+                self.trigger.resource_lock = pipeline.resource_locks.get(
+                                                            self.trigger.key)
+        if self.duts == 0:
+            # The expected time of one DUT says nothing about several
+            self.progress_stop()
+            self.progress_begin(0)
+            self.progress.grid()
+        self.duts += 1
+        self.pipeline.feed(trigger_value)
+        self.stopBtn.configure(state = 'normal')
+        self.pipeline_ready()
+
+    # Now thread safe
+    def stage_started(self, pipeline, n):
+        # Show the stage's tests as pending for the DUT that has moved into
+        # it (through the update queue, so they stay in order with the 
+        # tests' own updates)
+        for TestClass in pipeline.stage_tests[n]:
+            self.post_update(TestClass.id, 'pending')
+        if n == 0:
+            self.after(0, self.pipeline_ready)
+
+    def pipeline_ready(self):
+        '''Lets the operator (or the trigger) start the next DUT once the 
+        first stage can take it.'''
+        if self.pipeline is None or not self.pipeline.ready():
+            return
+        self.runBtn.configure(state = 'normal')
+        if self.trigger is not None:
+            self.trigger.arm()
+
 class Config(configparser.ConfigParser):
     '''Container for reading/writing configuration files.'''
-    def __init__(self, filename):
+    def __init__(self, filename = None):
         configparser.ConfigParser.__init__(self)
         self.filename = filename
-        self.read(filename)
+        if filename is not None:
+            self.read(filename)
+
+    def copy(self):
+        '''Returns an independent copy (sharing the part image).'''
+        cfg = Config()
+        cfg.filename = self.filename
+        cfg.read_dict(self)
+        cfg.image = getattr(self, 'image', None)
+        return cfg
 
     def save_to_file(self):
         cfgfile = open(self.filename,'w')
@@ -293,6 +525,10 @@ class ConfigWidget(VarLabelFrame):
         
         self.widgets['partnum'] = VarLabelCombo(self, 
                                     self.translatables['partnum'])
+        # Parsed config files and decoded images with the modification time
+        # they were loaded at, so a rescan only reloads what has changed
+        self.configCache = {}
+        self.imageCache = {}
         self.load_config_files()
         
         # Bind a part number change to a function to set the image
@@ -323,33 +559,64 @@ class ConfigWidget(VarLabelFrame):
 
     def load_config_files(self):
         self.configFiles = {}
+        images = set()
         for configFilename in glob('config/*.ini'):
             configStr = os.path.basename(configFilename)[:-4]
             # try:
             if True:
-                cfg = Config(configFilename)
-                cfg.image = tk.PhotoImage(file = cfg.get('image', 'part'))
+                mtime = os.stat(configFilename).st_mtime_ns
+                cached = self.configCache.get(configFilename)
+                if cached is not None and cached[0] == mtime:
+                    cfg = cached[1]
+                else:
+                    cfg = Config(configFilename)
+                    self.configCache[configFilename] = (mtime, cfg)
+                imageFilename = cfg.get('image', 'part')
+                # With --lazy, images are decoded when first shown
+                if not lazy_loading:
+                    cfg.image = self.load_image(imageFilename)
+                images.add(imageFilename)
                 # Only add the config file if it throws no exceptions above 
                 # so that we don't break the program for a single broken 
                 # configuration file.
                 self.configFiles[configStr] = cfg
             # except:
                 # pass
+        # Forget the part numbers (and images) that have been removed
+        configFilenames = set(cfg.filename for cfg in self.configFiles.values())
+        for configFilename in list(self.configCache.keys()):
+            if configFilename not in configFilenames:
+                del self.configCache[configFilename]
+        for imageFilename in list(self.imageCache.keys()):
+            if imageFilename not in images:
+                del self.imageCache[imageFilename]
         self.widgets['partnum'].set_values(list(self.configFiles.keys()))
         self.part_num_change()
 
+    def load_image(self, filename):
+        '''Returns the decoded image, only decoding it again when the file
+        has changed.'''
+        mtime = os.stat(filename).st_mtime_ns
+        cached = self.imageCache.get(filename)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, tk.PhotoImage(file = filename))
+            self.imageCache[filename] = cached
+        return cached[1]
+
     def update_config_files(self):
         # Rescan the config files
         self.load_config_files()
         # Update the config files with the entered information
         cfg = self.configFiles[self.widgets['partnum'].get()]
         sect = 'uservars'
-        cfg.add_section(sect)
+        # The parsed config is kept between scans
+        if not cfg.has_section(sect):
+            cfg.add_section(sect)
         # for key in ['opname', 'epcprefix', 'jobnum', 'shift', 'partnum']:
         for key in ['partnum']:
             cfg.set(sect, key, self.widgets[key].get())
-        # Give the procedure the updated configuration
-        self.parent.procedure.update_config(cfg)
+        # Give the procedures the updated configuration
+        self.parent.update_config(cfg)
 
     def start_job(self):
         self.update_config_files()
@@ -368,8 +635,7 @@ class ConfigWidget(VarLabelFrame):
     def end_job(self):
         # Request the parent to clear any pending tests (current test thread 
         # will continue until it ends)
-        self.parent.procedure.stop()
-        self.parent.procedure.end()
+        self.parent.end_procedures()
         # Enable the disable-able widgets
         self.enable()
         # Notify the GUI that we're ending a job
@@ -385,7 +651,10 @@ class ConfigWidget(VarLabelFrame):
         # Notify the GUI that the part number has changed
         # try:
         if True:
-            self.parent.part_number_change(self.configFiles[configName])
+            cfg = self.configFiles[configName]
+            # Decode the image if it wasn't already (--lazy)
+            cfg.image = self.load_image(cfg.get('image', 'part'))
+            self.parent.part_number_change(cfg)
             self.validProcedure = True
         # except KeyError:
             # self.validProcedure = False
@@ -405,57 +674,83 @@ def str_to_num(valStr):
         val = int(valStr)
     return val
 
-class CommissioningStation(ttk.Frame):
-    '''Main GUI window and message passer. Delegates to widgets.'''
-    def __init__(self, parent = None):
-        # Save the English translation in self.version_string
-        self.version_string = version_tuple[0]
-        
+class Fixture(VarLabelFrame):
+    '''One test fixture: its own procedure, test column and pass/fail face.
+    Receives the callbacks from its procedure.'''
+    def __init__(self, parent, name, bindings = None):
         self.parent = parent
-        ttk.Frame.__init__(self, parent)
-        
-        self.grid()
-        self.pass_image = tk.PhotoImage(file='images/GreenSmiley.gif')
-        self.fail_image = tk.PhotoImage(file='images/RedFrowny.gif')
-        self.translatables = {k:Translatable(v) for (k,v) in langDict.items()}
-        # Default to English
-        self.lang_idx = 0
-        self.lang_idx_max = len(self.translatables['lang'].translations) - 1
-        
-        self.face_canvas = tk.Canvas(self, width = self.pass_image.width(), 
+        self.name = name
+        # Equipment key to instrument address for the equipment bound to
+        # this fixture (passed to the procedure in the 'fixture' section)
+        self.bindings = dict(bindings or {})
+        self.translatables = parent.translatables
+        self.pass_image = parent.pass_image
+        self.fail_image = parent.fail_image
+        self.procedure = None
+        # Procedure module name to its Procedure, reused by every part 
+        # number that uses the same procedure
+        self.procedures = {}
+        # Register the title so that it is translated with everything else
+        title = Translatable([t%name for t in langDict['fixture']],
+                                lang_idx = parent.lang_idx)
+        self.translatables['%s.fixture'%name] = title
+        VarLabelFrame.__init__(self, parent, stringvar = title)
+
+        self.face_canvas = tk.Canvas(self, width = self.pass_image.width(),
                                 height = self.pass_image.height())
-        self.part_canvas = tk.Canvas(self)
         self.test_widget = TestWidget(self)
-        self.config_widget = ConfigWidget(self)
-        
-        self.config_widget.grid(row = 0, column = 0, sticky = tk.N)
-        self.part_canvas.grid(row = 1, column = 0, columnspan = 2)
-        self.face_canvas.grid(row = 0, column = 1)
-        self.test_widget.grid(row = 0, column = 2, rowspan = 2, 
-                                    sticky = tk.N)
+        self.face_canvas.grid(row = 0, column = 0, sticky = tk.N)
+        self.test_widget.grid(row = 1, column = 0, sticky = tk.N)
         self.test_widget.grid_remove()
 
-        # Set the default part image
-        self.config_widget.part_num_change()
-
-        # The root title doesn't support a StringVar, so we'll do it this way 
-        # (See VarLabelFrame for explanation):
-        text_var_title = self.translatables['title']
-        trans = lambda *args: parent.title(text_var_title.get())
-        text_var_title.trace('w', trans)
-        trans()
-        # Initialize in stopped mode
-        self.config_widget.end_job()
+    @property
+    def lang_idx(self):
+        return self.parent.lang_idx
 
     def get_version_string(self):
-        return self.version_string
+        return self.parent.get_version_string()
 
-    def next_language(self):
-        self.lang_idx += 1
-        if self.lang_idx > self.lang_idx_max:
-            self.lang_idx = 0
-        for tr in self.translatables.values():
-            tr.translate(self.lang_idx)
+    def part_number_change(self, config):
+        self.clear_face()
+        self.part_config = config
+        # With --lazy, a procedure that hasn't been loaded yet is loaded
+        # when the job is started (or the fixture is verified)
+        name = config.get('procedure', 'commissioning')
+        if not lazy_loading or name in self.procedures:
+            self.load_procedure()
+
+    def load_procedure(self):
+        config = self.part_config
+        name = config.get('procedure', 'commissioning')
+        procedure = self.procedures.get(name)
+        if procedure is None:
+            proc = import_module('procedures.' + name)
+            procedure = proc.Procedure(self, config)
+            self.procedures[name] = procedure
+        else:
+            procedure.update_config(config)
+        # The test list only changes with the procedure
+        if procedure is not self.procedure:
+            self.procedure = procedure
+            self.test_widget.set_tests(self.procedure.get_tests())
+
+    def update_config(self, config):
+        self.load_procedure()
+        # Give each fixture its own copy so that the procedure can find the
+        # equipment bound to this fixture
+        cfg = config.copy()
+        cfg.add_section('fixture')
+        cfg.set('fixture', 'name', self.name)
+        cfg.set('fixture', 'fixtures', str(len(self.parent.fixtures)))
+        for (key, address) in self.bindings.items():
+            cfg.set('fixture', key, address)
+        self.procedure.update_config(cfg)
+
+    def end_procedure(self):
+        if self.procedure is None:
+            return
+        self.procedure.stop()
+        self.procedure.end()
 
     def at_job_end(self):
         '''Actions to take when a job has ended.'''
@@ -474,13 +769,13 @@ class CommissioningStation(ttk.Frame):
     # Now thread safe
     def test_error(self, test, message):
         msg = 'Test Error:\n%s'%(message)
-        mb = MessageBox(self, tk.StringVar(self.parent, msg))
+        mb = MessageBox(self, tk.StringVar(self, msg))
         self.after(0, mb.create)
         self.after(0, self.test_widget.test_idle)
 
     # Now thread safe
     def test_callback(self, test):
-        self.test_widget.testUpdateQueue.put((test.id, test.state))
+        self.test_widget.post_update(test.id, test.state)
 
     # Now thread safe
     def procedure_callback(self, noFailures):
@@ -492,11 +787,11 @@ class CommissioningStation(ttk.Frame):
 
     def _procedure_callback_pass(self):
         self._set_smiley()
-        self.test_widget.test_idle()
+        self.test_widget.dut_finished()
 
     def _procedure_callback_fail(self):
         self._set_frowny()
-        self.test_widget.test_idle()
+        self.test_widget.dut_finished()
 
     def _set_smiley(self):
         self._clear_face()
@@ -517,33 +812,17 @@ class CommissioningStation(ttk.Frame):
         for x in self.face_canvas.find_all():
             self.face_canvas.delete(x)
 
-    def part_number_change(self, config):
-        img = config.image
-        # Delete anything on the canvas
-        for x in self.part_canvas.find_all():
-            self.part_canvas.delete(x)
-        self.part_canvas.create_image(0, 0, image = img, anchor = tk.NW)
-        self.part_canvas.configure(width = img.width(), height = img.height())
-        self.clear_face()
-        proc = import_module('procedures.' + config.get('procedure', 'commissioning'))
-        self.procedure = proc.Procedure(self, config)
-        self.test_widget.set_tests(self.procedure.get_tests())
-
     def verify(self):
-        self.config_widget.update_config_files()
-        self.config_widget.disable()
         self._clear_face()
         try:
             self.procedure.verify_start()
         except self.procedure.EquipmentFailure as e:
-            msg = 'Equipment failure:\n\t%s\n\t%s'%(e.name, e.message)
+            msg = 'Equipment failure:\n\t%s'%e.message
             mb = MessageBox(self, tk.StringVar(self, msg))
             self.after(0, mb.create)
             # Clean up after the failure
-            self._clear_face()
-            img = self.fail_image
-            self.face_canvas.create_image(0, 0, image = img, anchor = tk.NW)
-            self.config_widget.enable()
+            self._set_frowny()
+            self.parent.verify_done(self)
 
     def verify_callback(self, test):
         self.clear_face()
@@ -553,30 +832,164 @@ class CommissioningStation(ttk.Frame):
             self.after(0, self._set_smiley)
         else:
             self.after(0, self._set_frowny)
-        self.after(0, self.config_widget.enable)
+        self.parent.verify_done(self)
         # Display the results to the user
         mb = MessageBox(self, tk.StringVar(self, test.message))
         self.after(0, mb.create)
 
+    # Now thread safe
+    def operator_query(self, request):
+        self.after(0, self._operator_query, request)
+
+    def _operator_query(self, request):
+        # The request may have timed out before we got here
+        if request.answered:
+            return
+        msg = tk.StringVar(self, request.message[self.lang_idx])
+        if request.kind == 'pass_fail':
+            dialog = PassFailBox(self, msg, request.respond)
+        else:
+            # A cancelled entry gives the request's default
+            respond = lambda value: request.respond(
+                            request.default if value is None else value)
+            dialog = EntryBox(self, msg, respond,
+                            numeric = request.kind == 'number')
+        # Close the dialog when the request times out (or is cancelled)
+        request.add_callback(lambda: self.after(0, dialog.dismiss))
+        dialog.create()
+
+    # Now thread safe
     def pass_fail_query(self, test):
-        self.pfq_test = test
-        pfq = PassFailBox(self, tk.StringVar(self, test.message[self.lang_idx]),
-                                self.pass_fail_query_callback)
-        self.after(0, pfq.create)
+        '''For procedures written before operator_query: asks the operator
+        test.message and calls test.user_response('pass' or 'fail').'''
+        request = OperatorRequest('pass_fail', test.message, default = 'fail')
+        request.add_callback(lambda: test.user_response(request.value))
+        self.operator_query(request)
+
+def load_station_config(filename = station_config_file):
+    '''Returns a list of (name, bindings) for each fixture on the station.'''
+    cfg = Config(filename)
+    count = cfg.getint('station', 'fixtures', fallback = 1)
+    fixtures = []
+    for n in range(1, count + 1):
+        sect = 'fixture%d'%n
+        bindings = dict(cfg.items(sect)) if cfg.has_section(sect) else {}
+        name = bindings.pop('name', str(n))
+        fixtures.append((name, bindings))
+    return fixtures
+
+class CommissioningStation(ttk.Frame):
+    '''Main GUI window and message passer. Delegates to widgets.'''
+    def __init__(self, parent = None):
+        # Save the English translation in self.version_string
+        self.version_string = version_tuple[0]
+
+        self.parent = parent
+        ttk.Frame.__init__(self, parent)
+
+        self.grid()
+        with startup_profile.stage('load face images'):
+            self.pass_image = tk.PhotoImage(file='images/GreenSmiley.gif')
+            self.fail_image = tk.PhotoImage(file='images/RedFrowny.gif')
+        self.translatables = {k:Translatable(v) for (k,v) in langDict.items()}
+        # Default to English
+        self.lang_idx = 0
+        self.lang_idx_max = len(self.translatables['lang'].translations) - 1
+
+        self.part_canvas = tk.Canvas(self)
+        # Each fixture runs its own procedure side by side with the others
+        with startup_profile.stage('build fixtures'):
+            self.fixtures = [Fixture(self, name, bindings)
+                            for (name, bindings) in load_station_config()]
+        self.verify_lock = threading.Lock()
+        self.verifying = 0
+        with startup_profile.stage('load part numbers'):
+            self.config_widget = ConfigWidget(self)
+
+        self.config_widget.grid(row = 0, column = 0, sticky = tk.N)
+        self.part_canvas.grid(row = 1, column = 0)
+        for (n, fixture) in enumerate(self.fixtures):
+            fixture.grid(row = 0, column = n + 1, rowspan = 2, sticky = tk.N)
+
+        # Set the default part image
+        with startup_profile.stage('select part number'):
+            self.config_widget.part_num_change()
+
+        # The root title doesn't support a StringVar, so we'll do it this way
+        # (See VarLabelFrame for explanation):
+        text_var_title = self.translatables['title']
+        trans = lambda *args: parent.title(text_var_title.get())
+        text_var_title.trace('w', trans)
+        trans()
+        # Initialize in stopped mode
+        self.config_widget.end_job()
 
-    def pass_fail_query_callback(self, status):
-        self.pfq_test.user_response(status)
+    def get_version_string(self):
+        return self.version_string
+
+    def next_language(self):
+        self.lang_idx += 1
+        if self.lang_idx > self.lang_idx_max:
+            self.lang_idx = 0
+        for tr in self.translatables.values():
+            tr.translate(self.lang_idx)
+
+    def at_job_end(self):
+        '''Actions to take when a job has ended.'''
+        for fixture in self.fixtures:
+            fixture.at_job_end()
+
+    def at_job_start(self):
+        '''Actions to take when a job has started.'''
+        for fixture in self.fixtures:
+            fixture.at_job_start()
+
+    def update_config(self, config):
+        for fixture in self.fixtures:
+            fixture.update_config(config)
+
+    def end_procedures(self):
+        for fixture in self.fixtures:
+            fixture.end_procedure()
+
+    def part_number_change(self, config):
+        img = config.image
+        # Delete anything on the canvas
+        for x in self.part_canvas.find_all():
+            self.part_canvas.delete(x)
+        self.part_canvas.create_image(0, 0, image = img, anchor = tk.NW)
+        self.part_canvas.configure(width = img.width(), height = img.height())
+        for fixture in self.fixtures:
+            fixture.part_number_change(config)
+
+    def verify(self):
+        self.config_widget.update_config_files()
+        self.config_widget.disable()
+        with self.verify_lock:
+            self.verifying = len(self.fixtures)
+        for fixture in self.fixtures:
+            fixture.verify()
+
+    # Now thread safe
+    def verify_done(self, fixture):
+        # Re-enable the configuration once every fixture has been verified
+        with self.verify_lock:
+            self.verifying -= 1
+            if self.verifying > 0:
+                return
+        self.after(0, self.config_widget.enable)
+
+def write_startup_profile():
+    startup_profile.mark('window shown')
+    filename = get_option('profile-startup')
+    if filename is True:
+        filename = startup_profile.default_filename
+    startup_profile.write_report(filename)
 
 def write_error_file(*args):
-        # Ensure that the logs directory exists
-        dir = 'logs/'
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-        time_str = time.strftime('%Y-%m-%d %H:%M:%S')
-        err_file = open(dir + 'ProgramError.log', 'a')
-        err_file.write('-'*79 + '\n' + time_str + '\n' + '-'*79 + '\n')
-        err_file.write(traceback.format_exc())
-        err_file.close()
+        # Write the exception to logs/ProgramError.log, where the errors
+        # that background threads carry on from also go
+        error_log.write_error()
         sys.exit()
 
 class MessageBox(tkinter.simpledialog.Dialog):
@@ -607,12 +1020,20 @@ class PassFailBox(tkinter.simpledialog.Dialog):
         self.message = varMsg
         self.status = 'fail'
         self.callback = callback
+        self.shown = False
 
     def create(self):
         # Create the dialog window (blocking)
+        self.shown = True
         tkinter.simpledialog.Dialog.__init__(self, self.parent)
+        self.shown = False
         self.callback(self.status)
 
+    def dismiss(self):
+        '''Close the dialog if it is still open.'''
+        if self.shown:
+            self.cancel()
+
     def buttonbox(self):
         box = tk.Frame(self)
         button1 = ttk.Button(box, command = self.ok, default = tk.ACTIVE,
@@ -630,8 +1051,65 @@ class PassFailBox(tkinter.simpledialog.Dialog):
     def apply(self):
         self.status = 'pass'
 
+class EntryBox(tkinter.simpledialog.Dialog):
+    '''Asks the operator for a number or a string (a barcode scanner in
+    keyboard mode can scan straight into the entry).'''
+    def __init__(self, parent, varMsg, callback, numeric = False):
+        '''Override the init so we can create the window after config.'''
+        self.parent = parent
+        self.message = varMsg
+        self.callback = callback
+        self.numeric = numeric
+        self.value = None
+        self.shown = False
+
+    def create(self):
+        # Create the dialog window (blocking)
+        self.shown = True
+        tkinter.simpledialog.Dialog.__init__(self, self.parent)
+        self.shown = False
+        self.callback(self.value)
+
+    def dismiss(self):
+        '''Close the dialog if it is still open.'''
+        if self.shown:
+            self.cancel()
+
+    def buttonbox(self):
+        box = tk.Frame(self)
+        button = ttk.Button(box, command = self.ok, default = tk.ACTIVE,
+                textvariable = self.parent.translatables['continue'])
+        button.pack()
+        self.bind("<Return>", self.ok)
+        box.pack()
+
+    def body(self, master):
+        ttk.Label(master, textvariable = self.message).pack()
+        self.entry = ttk.Entry(master)
+        self.entry.pack()
+        # Give the entry the focus
+        return self.entry
+
+    def validate(self):
+        value = self.entry.get().strip()
+        if self.numeric:
+            try:
+                value = float(value)
+            except ValueError:
+                self.bell()
+                return False
+        self.value = value
+        return True
+
 if __name__ == '__main__':
+    # Needed by TestThread.run_isolated in the pyinstaller build
+    multiprocessing.freeze_support()
     try:
+        # Load every procedure up front (unless loading lazily) so that a
+        # broken procedure is found at startup
+        if release is not None and not lazy_loading:
+            with startup_profile.stage('import procedures'):
+                release.import_procedures()
         root = tk.Tk()
         # Write any exceptions to an error file and exit the program
         tk.Tk.report_callback_exception = write_error_file
@@ -640,7 +1118,11 @@ if __name__ == '__main__':
         # Don't allow the window to be resized
         root.resizable(0,0)
         # Initialize the application
-        app = CommissioningStation(root)
+        with startup_profile.stage('build window'):
+            app = CommissioningStation(root)
+        if startup_profile.enabled():
+            # The window is drawn by the first idle tasks of the main loop
+            root.after_idle(write_startup_profile)
     except Exception as e:
         # Write any exceptions to an error file and exit the program
         write_error_file(e)
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import configparser
+from importlib import import_module
+
+from equipment import SimulatedVisa
+from equipment import VisaResources
+from step_timing import percentile
+from pipeline import Pipeline
+
+# Runs a procedure headlessly (no GUI, simulated VISA instruments, an
+# operator that answers immediately) for a number of DUTs and reports the
+# per-step and per-DUT timing, so that sequencing overhead can be measured
+# and regressions caught without the fixture hardware.
+#
+#   python benchmark.py guitest -n 50
+#   python benchmark.py guitest_fail_continue -n 20 --latency 0.005
+#   python benchmark.py guitest -n 50 --operator-delay 0.1 --pipeline
+
+class HeadlessStation(object):
+    '''Stands in for the GUI as the parent of a procedure.'''
+    def __init__(self, operator_response = 'pass', operator_delay = 0.0):
+        self.operator_response = operator_response
+        self.operator_delay = operator_delay
+        self.done = threading.Event()
+        self.no_failures = None
+
+    def get_version_string(self):
+        return 'Benchmark'
+
+    def test_callback(self, test):
+        pass
+
+    def verify_callback(self, test):
+        pass
+
+    def test_error(self, test, message):
+        print('Test Error: %s'%message)
+
+    def procedure_callback(self, noFailures):
+        self.no_failures = noFailures
+        self.done.set()
+
+    def operator_query(self, request):
+        # Answer pass/fail questions as configured, anything else with the
+        # request's default
+        if request.kind == 'pass_fail':
+            answer = self.operator_response
+        else:
+            answer = request.default
+        timer = threading.Timer(self.operator_delay, request.respond, [answer])
+        timer.daemon = True
+        timer.start()
+
+def load_config(partnum):
+    config = configparser.ConfigParser()
+    config.read('config/%s.ini'%partnum)
+    config.add_section('uservars')
+    config.set('uservars', 'partnum', partnum)
+    return config
+
+def run_duts(procedure, station, count, timeout):
+    '''Returns ({step id: [seconds]}, [seconds per DUT], failures).'''
+    steps = {}
+    duts = []
+    failures = 0
+    # Collect every finished step from the procedure's own callback
+    test_callback = procedure.test_callback
+    def record(test):
+        if test.state in ['pass', 'fail'] and test.start_time is not None:
+            end = test.end_time or time.time()
+            steps.setdefault(test.id, []).append(end - test.start_time)
+        test_callback(test)
+    procedure.test_callback = record
+    for n in range(count):
+        station.done.clear()
+        start = time.time()
+        procedure.test_start()
+        if not station.done.wait(timeout):
+            raise RuntimeError('DUT %d did not finish in %ds'%(n, timeout))
+        duts.append(time.time() - start)
+        failures += not station.no_failures
+    return (steps, duts, failures)
+
+def run_pipeline(procedure, station, count, timeout, depth):
+    '''Runs the DUTs through the procedure's stages at the same time (see
+    pipeline). Returns ({step id: [seconds]}, [seconds per DUT], failures,
+    seconds in total).'''
+    steps = {}
+    duts = []
+    failures = []
+    def done(context):
+        duts.append(time.time() - context.start_time)
+        failures.append(not context.no_failures)
+    pipeline = Pipeline(station, procedure, depth, done_callback = done)
+    pipeline.start()
+    start = time.time()
+    for n in range(count):
+        context = pipeline.feed()
+        test_callback = context.test_callback
+        def record(test, test_callback = test_callback):
+            if test.state in ['pass', 'fail'] and test.start_time is not None:
+                end = test.end_time or time.time()
+                steps.setdefault(test.id, []).append(end - test.start_time)
+            test_callback(test)
+        context.test_callback = record
+    if not pipeline.wait_idle(timeout):
+        raise RuntimeError('The DUTs did not finish in %ds'%timeout)
+    total = time.time() - start
+    pipeline.close()
+    return (steps, duts, sum(failures), total)
+
+def print_table(rows):
+    pcts = [50, 90, 99]
+    print('%-24s %5s %9s %9s %9s %9s'%(('name', 'n') +
+                tuple('p%d ms'%p for p in pcts) + ('max ms',)))
+    for (name, values) in rows:
+        print('%-24s %5d %9.2f %9.2f %9.2f %9.2f'%((name, len(values)) +
+                    tuple(1000*percentile(values, p) for p in pcts) +
+                    (1000*max(values),)))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Headless cycle time '
+                                    'benchmark using simulated instruments')
+    parser.add_argument('partnum', help = 'configuration in config/')
+    parser.add_argument('-n', '--duts', type = int, default = 20)
+    parser.add_argument('--latency', type = float, default = 0.002,
+                        help = 'simulated instrument round trip (s)')
+    parser.add_argument('--noise', type = float, default = 0.001,
+                        help = 'relative std dev of simulated readings')
+    parser.add_argument('--operator-delay', type = float, default = 0.0,
+                        help = 'seconds the simulated operator takes')
+    parser.add_argument('--fail', action = 'store_true',
+                        help = 'simulated operator fails every DUT')
+    parser.add_argument('--timeout', type = float, default = 60)
+    parser.add_argument('--pipeline', type = int, nargs = '?', const = 1,
+                        default = 0, metavar = 'DEPTH',
+                        help = 'run the DUTs through the procedure\'s stages '
+                        'at the same time, DEPTH waiting for each stage')
+    args = parser.parse_args(argv)
+
+    VisaResources.use_resource_manager(SimulatedVisa.ResourceManager(
+                                latency = args.latency, noise = args.noise))
+    config = load_config(args.partnum)
+    proc = import_module('procedures.' + config.get('procedure',
+                                                    'commissioning'))
+    station = HeadlessStation('fail' if args.fail else 'pass',
+                                args.operator_delay)
+    procedure = proc.Procedure(station, config)
+    names = procedure.get_tests()
+    # Keep the logs (and results database) of the benchmark runs out of
+    # the station's logs directory
+    os.chdir(tempfile.mkdtemp(prefix = 'benchmark_'))
+
+    if args.pipeline:
+        (steps, duts, failures, total) = run_pipeline(procedure, station,
+                                args.duts, args.timeout, args.pipeline)
+    else:
+        (steps, duts, failures) = run_duts(procedure, station, args.duts,
+                                            args.timeout)
+        total = sum(duts)
+    print('%s: %d DUTs, %d failed, %.2f DUTs/min'%(args.partnum, len(duts),
+                                    failures, 60.0*len(duts)/total))
+    print_table([(names[k][0] if k in names else k, v)
+                    for (k, v) in steps.items()] + [('DUT total', duts)])
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -19,6 +19,7 @@ pyinstaller CommissioningStation.py \
 	-p procedures
 cp -r ./images ./dist/CommissioningStation/images
 cp -r ./config ./dist/CommissioningStation/config
+if [ -f station.ini ]; then cp station.ini ./dist/CommissioningStation/; fi
 
 mv ./dist/CommissioningStation  ./dist/CommissioningStation_$GIT_TAG
 
@@ -0,0 +1,73 @@
+import time
+import threading
+import queue as Queue
+import error_log
+
+# Shared by the barcode reader drivers: keeps the scanner armed from a
+# background thread and queues every decode with the time it was read, so
+# the operator can scan the next DUT's label while the current DUT is still
+# being tested, and the test takes the scan when it's ready for it.
+
+class ScanCapture(object):
+    '''Calls scan(timeout) (the driver's trigger-and-read) over and over
+    from a background thread, queueing (time, barcode) for each decode. 
+    When the queue is full the oldest scan is dropped.'''
+    def __init__(self, scan, maxsize = 16, poll = 1.0):
+        self.scan = scan
+        # Seconds the scanner is armed for before it is re-armed
+        self.poll = poll
+        self.queue = Queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, 
+                                        name = 'ScanCapture')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout = None):
+        '''Stop capturing (after the scan in progress, waiting up to 
+        timeout seconds for it).'''
+        self.stopped.set()
+        self.thread.join(timeout)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                barcode = self.scan(self.poll)
+            except Exception:
+                # Keep going (the reader may be back after a replug), but
+                # don't spin on the error
+                error_log.write_error()
+                self.stopped.wait(1)
+                continue
+            if barcode:
+                self.put((time.time(), barcode))
+
+    def put(self, scan):
+        while True:
+            try:
+                self.queue.put_nowait(scan)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+
+    def get(self, timeout = None):
+        '''Returns the oldest (time, barcode), waiting up to timeout seconds
+        (forever for None), or None.'''
+        try:
+            return self.queue.get(timeout = timeout)
+        except Queue.Empty:
+            return None
+
+    def clear(self):
+        '''Throw away the scans that haven't been taken (e.g. after a 
+        stop, so the next DUT doesn't get an old label).'''
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                return
@@ -1,37 +1,71 @@
-import serial
-from serial.tools import list_ports
+from equipment import BarcodeCapture
 
 class BarcodeReader(object):
     def __init__(self):
         self.connected = False
+        # Serial port of the reader to use when there is more than one
+        self.address = None
         self.name = 'Honeywell Quantum Barcode Reader'
+        # Background capture (see start_capture)
+        self.capture = None
 
     def connect(self):
+        # pyserial is only loaded once a reader is used
+        import serial
+        from serial.tools import list_ports
         ports = [p for p in list_ports.comports()]
         honeywell_id = 'Honeywell Bidirectional Device'
         barcode_readers = [x for x in ports if honeywell_id in x[1]]
+        if self.address is not None:
+            barcode_readers = [x for x in barcode_readers 
+                                if x[0] == self.address]
         count = len(barcode_readers)
         assert count == 1, 'Found %d Honeywell Quantums, expected 1'%count
         self.comm = serial.Serial(barcode_readers[0][0], 115200, timeout = 1)
         self.connected = True
         # Turn off the barcode reader's motor
-        self.comm.write('O')
+        self.comm.write(b'O')
 
     def disconnect(self):
+        self.stop_capture()
         self.comm.close()
         self.connected = False
 
-    def scan_barcode(self, timeout = 2):
+    def trigger_scan(self, timeout = 2):
         self.comm.timeout = timeout
         self.comm.flush()
         # Turn on the barcode readers motor (Extra O is to prevent 
         # lockup caused by sending two M's)
-        self.comm.write('OM')
-        data = self.comm.readline().strip()
+        self.comm.write(b'OM')
+        data = self.comm.readline().strip().decode('latin-1')
         # Turn off the barcode reader's motor
-        self.comm.write('O')
+        self.comm.write(b'O')
         return data
 
+    def start_capture(self, maxsize = 16):
+        '''Keep the scanner armed in the background, queueing every scan
+        for scan_barcode (or get_scan) to take.'''
+        if self.capture is None:
+            self.capture = BarcodeCapture.ScanCapture(self.trigger_scan,
+                                                        maxsize)
+            self.capture.start()
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
+
+    def get_scan(self, timeout = None):
+        '''Returns the oldest queued (time, barcode), or None after timeout
+        seconds. Only while capturing.'''
+        return self.capture.get(timeout)
+
+    def scan_barcode(self, timeout = 2):
+        if self.capture is not None:
+            scan = self.capture.get(timeout)
+            return scan[1] if scan is not None else ''
+        return self.trigger_scan(timeout)
+
 if __name__ == '__main__':
     br = BarcodeReader()
     br.connect()
@@ -1,36 +1,106 @@
-import serial
-from serial.tools import list_ports
 #import time
+import os
+import re
+import json
+import threading
+from equipment import BarcodeCapture
+
+# Settings written to the reader's non-volatile memory by setup() (so they
+# survive a power cycle), as menu tag (6 characters) and value
+SETTINGS = [
+    # # Use the RS232 mode with /r/n
+    # 'PAP232',
+    # Enable and set the activation character to 'a'
+    'HSTCEN1', 'HSTACH%02X'%ord('a'),
+    # Enable and set the deactivation character to 'd'
+    'HSTDEN1', 'HSTDCH%02X'%ord('d'),
+    # Turn off all barcode symbologies
+    'ALLENA0',
+    # Enable just code 128
+    '128ENA1',
+    # Only accept 16 character code128 barcodes
+    '128MIN16', '128MAX16',
+    ]
+# Settings that can't be queried back (ALLENA is an action on every 
+# symbology rather than a setting of its own). A reader is only trusted to
+# have these when this program wrote them to that reader (by serial number).
+UNCHECKED = ['ALLENA0']
+
+# Reader serial number: the SETTINGS this program last wrote to it
+configured_filename = 'logs/vuquest_configured.json'
+_configured_lock = threading.Lock()
+
+def load_configured(filename = configured_filename):
+    try:
+        with open(filename) as ifile:
+            return json.load(ifile)
+    except (IOError, ValueError):
+        return {}
+
+def save_configured(serial, settings, filename = configured_filename):
+    with _configured_lock:
+        configured = load_configured(filename)
+        configured[serial] = list(settings)
+        dir = os.path.dirname(filename)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+        # Write a new file and swap it in so a crash can't leave half a file
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as ofile:
+            json.dump(configured, ofile)
+        os.replace(tmp_filename, filename)
 
 class BarcodeReader(object):
     def __init__(self):
         self.connected = False
+        # Serial port of the reader to use when there is more than one
+        self.address = None
         self.name = 'Honeywell VuQuest 3310 Barcode Reader'
+        # Background capture (see start_capture)
+        self.capture = None
 
-    def setup(self):
-        # # Use the RS232 mode with /r/n
-        # self.nvm_command('PAP232')
-        # Sending this via the serial port causes serial write issues for the
-        # next command if we don't insert a long delay
+    def setup(self, force = False):
+        '''Write SETTINGS to the reader (in one command) unless this program
+        has already written them to this reader (by serial number) and it
+        still has them. Returns whether anything was written.'''
+        # Sending PAP232 via the serial port causes serial write issues for
+        # the next command if we don't insert a long delay
         # time.sleep(2)
-        # Enable and set the activation character to 'a'
-        self.nvm_command('HSTCEN1')
-        self.nvm_command('HSTACH%02X'%ord('a'))
-        # Enable and set the deactivation character to 'd'
-        self.nvm_command('HSTDEN1')
-        self.nvm_command('HSTDCH%02X'%ord('d'))
-        # Turn off all barcode symbologies
-        self.nvm_command('ALLENA0')
-        # Enable just code 128
-        self.nvm_command('128ENA1')
-        # Only accept 16 character code128 barcodes
-        self.nvm_command('128MIN16')
-        self.nvm_command('128MAX16')
+        serial = self.get_serial()
+        if not force and serial is not None:
+            if load_configured().get(serial) == SETTINGS and \
+                                                    self.is_configured():
+                return False
+        self.nvm_command(';'.join(SETTINGS))
+        if serial is not None:
+            save_configured(serial, SETTINGS)
+        return True
+
+    def get_serial(self):
+        '''Returns the reader's serial number from its revision report, or
+        None when it isn't in the report.'''
+        self.send_command('REVINF.')
+        # The report has '.'s in the version numbers, so read to the ACK
+        resp = self.comm.read_until(b'\x06.').decode('latin-1')
+        match = re.search(r'Serial Number:\s*(\S+)', resp)
+        return match.group(1) if match else None
+
+    def is_configured(self):
+        '''Checks the reader's settings against SETTINGS with one query.'''
+        settings = [x for x in SETTINGS if x not in UNCHECKED]
+        resp = self.menu_command(';'.join(x[:6] + '?' for x in settings))
+        return resp == self.expected_response(settings)
 
     def connect(self):
+        # pyserial is only loaded once a reader is used
+        import serial
+        from serial.tools import list_ports
         ports = [p for p in list_ports.comports()]
         honeywell_id = 'Vuquest 3310 Area-Imaging Scanner'
         barcode_readers = [x for x in ports if honeywell_id in x[1]]
+        if self.address is not None:
+            barcode_readers = [x for x in barcode_readers 
+                                if x[0] == self.address]
         try:
             reader_id = barcode_readers[0][0]
             self.comm = serial.Serial(reader_id, 115200, timeout = 1)
@@ -41,27 +111,62 @@ class BarcodeReader(object):
         return self.connected
 
     def disconnect(self):
+        self.stop_capture()
         self.comm.close()
         self.connected = False
 
-    def scan_barcode(self, timeout = 2):
+    def trigger_scan(self, timeout = 2):
         self.comm.timeout = timeout
         self.comm.flush()
-        self.comm.write('a')
-        data = self.comm.readline().strip()
-        self.comm.write('d')
+        self.comm.write(b'a')
+        data = self.comm.readline().strip().decode('latin-1')
+        self.comm.write(b'd')
         return data
 
+    def start_capture(self, maxsize = 16):
+        '''Keep the scanner armed in the background, queueing every scan
+        for scan_barcode (or get_scan) to take.'''
+        if self.capture is None:
+            self.capture = BarcodeCapture.ScanCapture(self.trigger_scan,
+                                                        maxsize)
+            self.capture.start()
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
+
+    def get_scan(self, timeout = None):
+        '''Returns the oldest queued (time, barcode), or None after timeout
+        seconds. Only while capturing.'''
+        return self.capture.get(timeout)
+
+    def scan_barcode(self, timeout = 2):
+        if self.capture is not None:
+            scan = self.capture.get(timeout)
+            return scan[1] if scan is not None else ''
+        return self.trigger_scan(timeout)
+
     def send_command(self, command):
         # Menu commands require a SYN M CR prefix
-        self.comm.write(''.join(map(chr,[22, 77, 13])) + command)
+        data = ''.join(map(chr,[22, 77, 13])) + command
+        self.comm.write(data.encode('latin-1'))
 
-    def nvm_command(self, command):
+    def menu_command(self, command):
+        '''Sends a menu command (or several joined with ';') and returns the
+        response, which ends in '.', as soon as it has arrived.'''
         self.send_command(command + '.')
-        resp = self.comm.read(4096)
-        # Ensure that the command is ACKd
-        exp = command + '\x06.'
-        assert exp == resp, 'expected: %s, received: %s'%(exp, resp)
+        return self.comm.read_until(b'.').decode('latin-1')
+
+    def expected_response(self, commands):
+        # Each command is echoed with an ACK
+        return ';'.join(command + '\x06' for command in commands) + '.'
+
+    def nvm_command(self, command):
+        resp = self.menu_command(command)
+        # Ensure that every command is ACKd
+        exp = self.expected_response(command.split(';'))
+        assert exp == resp, 'expected: %r, received: %r'%(exp, resp)
 
 if __name__ == '__main__':
     br = BarcodeReader()
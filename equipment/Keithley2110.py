@@ -1,23 +1,24 @@
-import pyvisa
+from equipment import VisaResources
 import time
 
 class Multimeter(object):
     def __init__(self):
         self.connected = False
+        # Resource name (or part of it, like the serial number) of the
+        # instrument to use when there is more than one connected
+        self.address = None
         self.name = 'Keithley 2110 Multimeter'
+        # Readings taken per trigger (set by read_current_burst)
+        self.sample_count = 1
 
     def connect(self):
-        rm = pyvisa.ResourceManager()
-        resources = rm.list_resources()
         id = '::0x05E6::0x2110::' #2110 VID/PID
-        inst = [x for x in resources if id in x]
-        try:
-            self.comm = rm.get_instrument(inst[0])
-            self.get_id()
-            self.connected = True
-        except:
-            self.comm = None
-            self.connected = False
+        # Reuse the shared discovery and any session that is already open,
+        # using *IDN? as the liveness check
+        self.comm = VisaResources.connect(id, self.address)
+        self.connected = self.comm is not None
+        # Unknown until it is set again
+        self.sample_count = None
         return self.connected
 
     def disconnect(self):
@@ -25,19 +26,67 @@ class Multimeter(object):
         self.connected = False
 
     def get_id(self):
-        return self.comm.ask('*IDN?').strip()
+        return self.comm.query('*IDN?').strip()
 
     def setup_current_read(self):
         self.comm.write(':CONF:CURR 0.1, MIN')
-        self.comm.ask(':MEAS:CURR?')
+        # CONF resets the trigger and sample counts to 1
+        self.sample_count = 1
+        self.comm.query(':MEAS:CURR?')
+
+    def set_sample_count(self, count):
+        if count != self.sample_count:
+            self.comm.write(':TRIG:SOUR IMM;:TRIG:COUN 1;:SAMP:COUN %d'%count)
+            self.sample_count = count
 
     def read_current(self):
-        return float(self.comm.ask(':READ?'))
+        self.set_sample_count(1)
+        return float(self.comm.query(':READ?'))
+
+    def read_current_burst(self, count = 100, nplc = None):
+        '''Returns (numpy array of count readings, seconds per reading). The
+        meter takes the readings back to back on one trigger and they are
+        fetched in a single transfer. nplc (power line cycles per reading)
+        trades noise for speed.'''
+        # numpy is only needed (and loaded) for burst readings
+        import numpy
+        if nplc is not None:
+            self.comm.write(':CURR:DC:NPLC %g'%nplc)
+        self.set_sample_count(count)
+        start = time.time()
+        # The 2110 only returns its buffer as comma separated ASCII
+        resp = self.comm.query(':READ?')
+        period = (time.time() - start)/count
+        samples = numpy.array(resp.strip().split(','), dtype = float)
+        return (samples, period)
 
     def current_sense_bypass(self):
         # Bypass the larger resistors used for the lower current measurement
         # ranges by setting the current range to MAX
         self.comm.write(':CONF:CURR MAX, MIN')
+        self.sample_count = 1
+
+def burst_stats(samples, period = None, tolerance = 0.01):
+    '''Returns a dictionary of the min, max, mean and std of the samples,
+    and settling: the time (or the number of samples without a period) 
+    before the samples stay within tolerance (relative) of the final value
+    (the mean of the last quarter), or None if they never do.'''
+    import numpy
+    samples = numpy.asarray(samples, dtype = float)
+    final = samples[-max(1, len(samples)//4):].mean()
+    outside = numpy.flatnonzero(numpy.abs(samples - final) > 
+                                tolerance*abs(final))
+    if len(outside) == 0:
+        settled = 0
+    elif outside[-1] == len(samples) - 1:
+        settled = None
+    else:
+        settled = outside[-1] + 1
+    if settled is not None and period is not None:
+        settled = float(settled*period)
+    return {'min': float(samples.min()), 'max': float(samples.max()), 
+            'mean': float(samples.mean()), 'std': float(samples.std()), 
+            'final': float(final), 'settling': settled}
 
 if __name__ == '__main__':
     start = time.time()
@@ -1,5 +1,3 @@
-import serial
-from serial.tools import list_ports
 from equipment.RfidReader import Reader
 from binascii import hexlify, unhexlify
 
@@ -8,8 +6,12 @@ class RfidReader(Reader):
         self.connected = False
         self.name = 'Motorola FX9500 RFID Reader'
         self.ip_addr = None
+        # IP address of the reader to use when there is more than one
+        self.address = None
 
     def connect(self, username = 'admin', password = 'change', ip_addr = None):
+        if ip_addr is None:
+            ip_addr = self.address
         # If we're given an IP address, try using that first.
         if ip_addr is not None:
             try:
@@ -42,6 +44,8 @@ class RfidReader(Reader):
         return False
 
     def get_ip_from_serial_port(self, username, password):
+        # pyserial is only loaded once a reader is used
+        from serial.tools import list_ports
         ports = [p for p in list_ports.comports()]
         fx9500_id = 'VID:PID=0525:A4A7'
         inst = [x for x in ports if fx9500_id in x[2]]
@@ -1,14 +1,93 @@
 #!/usr/bin/python -u
-import serial
+import time
 import socket
 # This works with Sirit 510/610 and Motorola FX9500 and connects over 
 # serial port (if name has COM in it) or ethernet
 
+# Every response on the command channel ends with a blank line
+RESPONSE_END = b'\r\n\r\n'
+
+class TagOperation(object):
+    '''One read or write of a tag's memory for Reader.tag_batch. Afterwards
+    ok says whether it succeeded, data holds the hex string read (without
+    leading 0x), error the exception (or None) and verified whether the
+    written words read back the same (None when not verified).'''
+    kinds = ['read', 'write']
+
+    def __init__(self, kind, epc, bank, word_ptr, data = '', word_count = 0):
+        assert kind in self.kinds, 'Unknown tag operation: %s'%kind
+        self.kind = kind
+        self.epc = epc
+        # The EPC the tag is addressed by, which tag_batch changes when an
+        # earlier operation in the batch rewrites the EPC
+        self.address = epc
+        self.bank = bank
+        self.word_ptr = word_ptr
+        self.data = data
+        if kind == 'write':
+            # Four hex digits per word
+            word_count = len(self.hex_data)//4
+        self.word_count = word_count
+        self.ok = False
+        self.error = None
+        self.verified = None
+
+    @property
+    def hex_data(self):
+        data = self.data
+        return data[2:] if data[:2].lower() == '0x' else data
+
+    def command(self, reader):
+        if self.kind == 'read':
+            return reader.read_command(self.address, self.bank, 
+                                        self.word_ptr, self.word_count)
+        return reader.write_command(self.address, self.bank, self.word_ptr,
+                                    self.data)
+
+    def new_epc(self, epc):
+        '''Returns the EPC a tag with the given EPC has after this operation
+        (the EPC starts at word 2 of bank 1).'''
+        if self.kind != 'write' or self.bank != 1 or self.word_ptr < 2:
+            return epc
+        prefix = epc[:2] if epc[:2].lower() == '0x' else ''
+        old = epc[len(prefix):]
+        start = 4*(self.word_ptr - 2)
+        if start > len(old):
+            return epc
+        data = self.hex_data
+        return prefix + old[:start] + data + old[start + len(data):]
+
+class TagReport(object):
+    '''A tag seen by Reader.stream_tags.'''
+    def __init__(self, epc):
+        self.epc = epc
+        self.antenna = None
+        self.rssi = None
+        self.count = 0
+
+    def update(self, fields):
+        if 'antenna' in fields:
+            self.antenna = int(fields['antenna'], 0)
+        if 'rssi' in fields:
+            self.rssi = int(fields['rssi'], 0)
+        if 'repeat' in fields:
+            self.count = int(fields['repeat'], 0)
+
+    def __repr__(self):
+        return 'TagReport(%s, antenna=%s, rssi=%s, count=%d)'%(self.epc, 
+                                        self.antenna, self.rssi, self.count)
+
 class Reader(object):
-    def __init__(self, address, username, password, timeout=10):
+    def __init__(self, address, username, password, timeout=10, 
+                    rawmode=False):
         self.is_live = False
         self.is_serial = 'COM' in address
         self.address = address
+        # Seconds to wait for a response before raising TimeoutError
+        self.timeout = timeout
+        # Use the serial port's raw mode (no echo or prompt, responses are
+        # framed like they are on the network)
+        self.rawmode = rawmode
         if not self.is_serial:
             try:
                 self.comm = socket.socket()
@@ -17,6 +96,12 @@ class Reader(object):
                 raise self.ConnectionError(e)
         self.address = address
         self.block_write_enabled = False
+        # Data received from the socket but not returned yet, and how much of
+        # it has already been searched for the end of a response
+        self.rx = bytearray()
+        self.rx_searched = 0
+        # Reused for every recv so that large responses don't allocate
+        self.rx_chunk = bytearray(4096)
         self.open()
         resp = self.send('reader.login(%s,%s)'%(username, password))
         if resp[:2] != 'ok':
@@ -26,49 +111,116 @@ class Reader(object):
     def open(self):
         if not self.is_live:
             if self.is_serial:
+                # pyserial is only loaded for a serial connection
+                import serial
                 self.comm = serial.Serial(self.address, 115200)
-                self.comm.timeout = 0
-                self.send = self.send_serial
-                self.send('')
+                self.transmit = self.comm.write
+                self.receive = self.receive_serial
+                if self.rawmode:
+                    self.enter_rawmode()
+                    self.send = self.send_socket
+                    self.send_many = self.send_many_socket
+                else:
+                    self.send = self.send_serial
+                    self.send_many = self.send_many_serial
+                    self.send('')
             else:
                 self.comm.connect((self.address, 50007))
+                self.transmit = self.comm.sendall
+                self.receive = self.receive_socket
                 self.send = self.send_socket
+                self.send_many = self.send_many_socket
             self.is_live = True;
     
     def send_socket(self, command):
-        self.comm.send(command + '\r\n')
-        data = ''
-        while '\r\n\r\n' not in data:
-            data = data + self.comm.recv(4096)
-        return data.strip()
+        return self.send_many_socket([command])[0]
+
+    def send_many_socket(self, commands):
+        '''Send all of the commands before reading any of the responses, so
+        that a sequence of commands only pays for one round trip. Returns
+        the responses in the same order. (Also used on the serial port in
+        raw mode, which is framed the same way.)'''
+        deadline = time.time() + self.timeout
+        data = ''.join(command + '\r\n' for command in commands)
+        self.transmit(data.encode('latin-1'))
+        return [self.read_response(deadline) for command in commands]
+
+    def read_response(self, deadline):
+        '''Returns the next complete response.'''
+        while True:
+            # Only search the newly received bytes (backing up enough to 
+            # catch an end marker split across two chunks)
+            start = max(0, self.rx_searched - len(RESPONSE_END) + 1)
+            end = self.rx.find(RESPONSE_END, start)
+            if end >= 0:
+                data = bytes(self.rx[:end])
+                # Keep anything after the marker (pipelined responses)
+                del self.rx[:end + len(RESPONSE_END)]
+                self.rx_searched = 0
+                return data.decode('latin-1').strip()
+            self.rx_searched = len(self.rx)
+            self.rx += self.receive(deadline)
+
+    def receive_socket(self, deadline):
+        # The socket's own timeout applies here
+        count = self.comm.recv_into(self.rx_chunk)
+        if count == 0:
+            raise self.ConnectionError('Connection closed by the reader')
+        return memoryview(self.rx_chunk)[:count]
+
+    def receive_serial(self, deadline):
+        '''Blocks until data arrives (without using any CPU), then returns
+        everything that is waiting. Raises TimeoutError at the deadline.'''
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise self.TimeoutError('No response from %s in %ds'%(
+                                                self.address, self.timeout))
+        self.comm.timeout = remaining
+        return self.comm.read(max(1, self.comm.in_waiting))
+
+    def enter_rawmode(self):
+        # Works whether or not the reader was left in raw mode: send the 
+        # setting and throw away whatever comes back (echo and prompt, or a
+        # raw response), waiting until the port goes quiet
+        self.comm.write(b'com.serial.rawmode = true\r\n')
+        self.comm.timeout = 0.2
+        while self.comm.read(4096):
+            pass
+        self.rx = bytearray()
+        self.rx_searched = 0
 
     def send_serial(self, command):
-        # It may be worth looking into com.serial.rawmode, which removes 
-        # some of the silliness I hack out here and it may be slightly faster
+        deadline = time.time() + self.timeout
         # Enter the command and wait for the echo to come back
-        self.comm.write(command)
-        resp = ''
-        while 1:
-            resp += self.comm.read(4096)
-            # Compare a whitespace-stripped version of the command because 
-            # the terminal tries to be fancy with automatic line wrapping
-            if ''.join(command.split()) in ''.join(resp.split()):
-                break
+        self.comm.write(command.encode('latin-1'))
+        # Compare a whitespace-stripped version of the command because 
+        # the terminal tries to be fancy with automatic line wrapping
+        echo_target = ''.join(command.split())
+        echo = ''
+        while echo_target not in echo:
+            chunk = self.receive_serial(deadline).decode('latin-1')
+            # Only keep enough of the stripped echo to find the command
+            echo = echo[-len(echo_target):] + ''.join(chunk.split())
         # Now execute the command
         # Note: sending /r/n will yield double prompts
-        self.comm.write('\n')
+        self.comm.write(b'\n')
         # Collect data, ensuring it ends in a new prompt
-        data = ''
-        while 1:
-            data += self.comm.read(4096)
-            if (data.endswith('>>> ')):
-                break
+        data = bytearray()
+        while not data.endswith(b'>>> '):
+            data += self.receive_serial(deadline)
         # Strip off the prompt and any whitespace before returning
-        data = data.replace('>>> ', '')
+        data = data.decode('latin-1').replace('>>> ', '')
         return data.strip()
 
+    def send_many_serial(self, commands):
+        # The serial console echoes each command, so it can't be pipelined
+        return [self.send_serial(command) for command in commands]
+
     def get(self, config):
-        data = self.send(config)
+        return self.check_response(self.send(config))
+
+    def check_response(self, data):
+        '''Returns the data of an ok response, or raises the error.'''
         if data[:2] == 'ok':
             return data[2:].strip()
         else:
@@ -78,6 +230,12 @@ class Reader(object):
 
     def close(self):
         if self.is_live:
+            if self.is_serial and self.rawmode:
+                # Leave the serial console usable for the next connection
+                try:
+                    self.send('com.serial.rawmode = false')
+                except Exception:
+                    pass
             try:
                 self.comm.close()
                 self.is_live = False
@@ -90,54 +248,160 @@ class Reader(object):
         self.send(cmd + str(enable))
         self.block_write_enabled = enable
 
-    def tag_read(self, epc, bank, word_ptr, len):
-        '''Returns hex string without leading 0x on success'''
+    def read_command(self, epc, bank, word_ptr, len):
         arg_str = ','.join(['tag_id=' + epc, 'mem_bank=' + hex(bank), 
                         'word_ptr=' + hex(word_ptr), 'word_count=' + hex(len)])
-        cmd_str = 'modem.protocol.isoc.read(%s)'%arg_str
-        response = self.get(cmd_str)
-        resp_data = response.replace('data = 0x','')
+        return 'modem.protocol.isoc.read(%s)'%arg_str
+
+    def write_command(self, epc, bank, word_ptr, data):
+        arg_str = ','.join(['tag_id=' + epc, 'mem_bank=' + hex(bank), 
+                        'word_ptr=' + hex(word_ptr), 'data=' + data])
+        return 'modem.protocol.isoc.write(%s)'%arg_str
+
+    def check_read(self, response):
+        '''Returns the hex string (without leading 0x) of a read response.'''
+        resp_data = self.check_response(response).replace('data = 0x','')
         try:
             int(resp_data, 16)
         except:
             raise self.ReaderError('Invalid read response: %s'%response)
         return resp_data
 
+    def tag_read(self, epc, bank, word_ptr, len):
+        '''Returns hex string without leading 0x on success'''
+        return self.check_read(self.send(self.read_command(epc, bank, 
+                                                        word_ptr, len)))
+
     def tag_write(self, epc, bank, word_ptr, data):
         '''Returns empty string on success'''
-        arg_str = ','.join(['tag_id=' + epc, 'mem_bank=' + hex(bank), 
-                        'word_ptr=' + hex(word_ptr), 'data=' + data])
-        cmd_str = 'modem.protocol.isoc.write(%s)'%arg_str
-        return self.get(cmd_str)
+        return self.get(self.write_command(epc, bank, word_ptr, data))
+
+    def tag_batch(self, operations, verify = False):
+        '''Runs a list of TagOperations (on one tag or several) with all of
+        the commands sent before any response is read, and returns the
+        operations with their results filled in. A failed operation doesn't
+        stop the others. With verify, the words written by the successful
+        writes are read back (in one more round trip) and compared.
+
+        Operations address the tag by EPC. When the batch writes a tag's EPC
+        the operations after it on that tag (and the read backs) use the 
+        new EPC.'''
+        epcs = {}
+        for op in operations:
+            op.address = epcs.get(op.epc, op.epc)
+            epcs[op.epc] = op.new_epc(op.address)
+        responses = self.send_many([op.command(self) for op in operations])
+        for (op, response) in zip(operations, responses):
+            try:
+                if op.kind == 'read':
+                    op.data = self.check_read(response)
+                else:
+                    self.check_response(response)
+                op.ok = True
+            except (self.ReaderError, self.TagNotFoundError) as e:
+                op.error = e
+        if verify:
+            # The EPC each tag has now, following the EPC writes that worked
+            epcs = {}
+            for op in operations:
+                if op.ok:
+                    epcs[op.epc] = op.new_epc(epcs.get(op.epc, op.epc))
+            writes = [op for op in operations if op.kind == 'write' and op.ok]
+            responses = self.send_many([self.read_command(
+                                epcs.get(op.epc, op.epc), op.bank, op.word_ptr,
+                                op.word_count) for op in writes])
+            for (op, response) in zip(writes, responses):
+                try:
+                    read_back = self.check_read(response)
+                except (self.ReaderError, self.TagNotFoundError) as e:
+                    read_back = None
+                    op.error = e
+                op.verified = read_back is not None and \
+                                read_back.upper() == op.hex_data.upper()
+                if not op.verified:
+                    op.ok = False
+                    if op.error is None:
+                        op.error = self.ReaderError('Read back %s, wrote %s'%(
+                                                    read_back, op.hex_data))
+        return operations
 
     def write_epc(self, epc_str):
         '''Write a new EPC to the first tag found'''
         cmd_str = 'tag.write_id(new_tag_id=%s)'%epc_str
         resp = self.get(cmd_str)
 
-    def find_tag(self):
-        '''Returns the EPC of the first tag found'''
+    def find_tag(self, timeout = None):
+        '''Returns the EPC of the first tag found, blocking until there is
+        one (or raising TagNotFoundError after timeout seconds)'''
         arg_str = 'mem_bank=1,word_ptr=2,word_count=6'
         cmd_str = 'modem.protocol.isoc.read(%s)'%arg_str
         epc_str = None
-        # Block until a tag is found
+        deadline = None if timeout is None else time.time() + timeout
+        # Back off between attempts so an empty fixture doesn't keep the
+        # reader (and this thread) busy
+        delay = 0.01
         while epc_str == None:
             try:
                 epc_str = self.get(cmd_str).replace('data = 0x','')
             except self.TagNotFoundError as e:
-                pass
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+                delay = min(2*delay, 0.2)
         return epc_str
 
-    def find_tags(self, milliseconds = 2000):
-        self.get('tag.reporting.taglist_fields = tag_id')
+    def stream_tags(self, expected = None, timeout = 2.0, poll_ms = 100):
+        '''Yields a TagReport for each tag as the reader first reports it,
+        stopping once expected tags have been found or after timeout 
+        seconds. The reports keep being updated (rssi, antenna, count) 
+        while the inventory runs.'''
+        deadline = time.time() + timeout
+        self.get('tag.reporting.taglist_fields = tag_id, antenna, rssi, '
+                'repeat')
         self.get('tag.db.purge()')
-        db = self.get('tag.db.scan_tags(%d)'%milliseconds).split('\r\n')
-        epcs = []
-        for entry in db:
-            entry = entry.strip().strip('()').split('=')
-            if entry[0] == 'tag_id':
-                epcs.append(entry[1].replace('0x',''))
-        return epcs
+        tags = {}
+        while expected is None or len(tags) < expected:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            scan_ms = max(1, int(1000*min(poll_ms/1000.0, remaining)))
+            db = self.get('tag.db.scan_tags(%d)'%scan_ms)
+            for fields in self.parse_tag_db(db):
+                if 'tag_id' not in fields:
+                    continue
+                epc = fields['tag_id'].replace('0x', '')
+                new = epc not in tags
+                if new:
+                    tags[epc] = TagReport(epc)
+                tags[epc].update(fields)
+                if new:
+                    yield tags[epc]
+                    if expected is not None and len(tags) >= expected:
+                        return
+
+    def parse_tag_db(self, db):
+        '''Returns a dictionary of the fields of each tag in a tag.db 
+        response: (tag_id=0x..., antenna=1, rssi=-512, repeat=3)'''
+        entries = []
+        for entry in db.split('\r\n'):
+            entry = entry.strip().strip('()')
+            if not entry:
+                continue
+            fields = {}
+            for field in entry.split(','):
+                (key, _, value) = field.partition('=')
+                fields[key.strip()] = value.strip()
+            entries.append(fields)
+        return entries
+
+    def find_tags(self, milliseconds = 2000, expected = None):
+        '''Returns the EPCs of the tags found in milliseconds, returning as
+        soon as expected tags have been found'''
+        return [tag.epc for tag in self.stream_tags(expected, 
+                                                    milliseconds/1000.0)]
 
     # Check for known/expected errors and raise the appropriate exception
     def reader_error_handler(self, string):
@@ -177,6 +441,13 @@ class Reader(object):
         def __str__(self):
             return self.string
 
+    class TimeoutError(Exception):
+        def __init__(self, string):
+            self.string = string
+
+        def __str__(self):
+            return self.string
+
     class LoginError(Exception):
         def __init__(self, string):
             self.string = string
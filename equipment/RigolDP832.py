@@ -1,46 +1,93 @@
-import pyvisa
+import time
+from equipment import VisaResources
+from equipment import SupplySettling
 
 class PowerSupply(object):
     def __init__(self):
         self.connected = False
+        # Resource name (or part of it, like the serial number) of the
+        # instrument to use when there is more than one connected
+        self.address = None
         self.name = 'Rigol DP832 Power Supply'
+        # Programmed output (see the properties below), so repeated 
+        # settings are skipped
+        self.state = {}
 
     def connect(self):
-        rm = pyvisa.ResourceManager()
-        resources = rm.list_resources()
         id = '::0x1AB1::0x0E11::' #DP832 VID/PID
-        inst = [x for x in resources if id in x]
-        try:
-            self.comm = rm.get_instrument(inst[0])
-            self.get_id()
-            self.connected = True
-        except:
-            self.comm = None
-            self.connected = False
+        # Reuse the shared discovery and any session that is already open,
+        # using *IDN? as the liveness check
+        self.comm = VisaResources.connect(id, self.address)
+        self.connected = self.comm is not None
+        if self.connected:
+            # Shared with any other driver object using this supply, which
+            # may have been changed from the front panel
+            self.state = VisaResources.session_state(self.comm)
+            self.state.clear()
         return self.connected
 
     def disconnect(self):
         self.comm = None
         self.connected = False
+        self.state = {}
+
+    # The output last programmed (None until set), by any driver object
+    @property
+    def voltage(self):
+        return self.state.get('voltage')
+
+    @property
+    def current_limit(self):
+        return self.state.get('current_limit')
+
+    @property
+    def output(self):
+        return self.state.get('output')
 
     def get_id(self):
-        return self.comm.ask('*IDN?').strip()
+        return self.comm.query('*IDN?').strip()
 
     def set_voltage(self, voltage = 3.0, currentLimit = 0.5):
-        self.comm.write(':APPL CH3,%f,%f'%(voltage, currentLimit))
+        if (voltage, currentLimit) != (self.voltage, self.current_limit):
+            self.comm.write(':APPL CH3,%f,%f'%(voltage, currentLimit))
+            self.state.update(voltage = voltage, current_limit = currentLimit)
 
     def enable(self):
-        self.comm.write(':OUTP CH3,ON')
+        if self.output is not True:
+            self.comm.write(':OUTP CH3,ON')
+            self.state['output'] = True
 
     def disable(self):
-        self.comm.write(':OUTP CH3,OFF')
+        if self.output is not False:
+            self.comm.write(':OUTP CH3,OFF')
+            self.state['output'] = False
+
+    def measure(self):
+        '''Returns the measured (voltage, current) in one round trip.'''
+        # Voltage, current and power
+        resp = self.comm.query(':MEAS:ALL? CH3').strip()
+        (voltage, current) = resp.split(',')[:2]
+        return (float(voltage), float(current))
+
+    def measure_voltage(self):
+        return float(self.comm.query(':MEAS:VOLT? CH3'))
+
+    def measure_current(self):
+        return float(self.comm.query(':MEAS:CURR? CH3'))
+
+    def wait_settled(self, tolerance = 0.01, timeout = 2.0, sleep = None):
+        '''Returns the (voltage, current) once the output is stable, instead
+        of sleeping for a fixed time (see SupplySettling.wait_settled).'''
+        setpoint = self.voltage if self.output else None
+        return SupplySettling.wait_settled(self.measure, setpoint, 
+                            self.current_limit, tolerance, timeout,
+                            sleep = sleep or time.sleep)
 
 if __name__ == '__main__':  
-    import time
     ps = PowerSupply()
     ps.connect()
     print(ps.get_id())
     ps.set_voltage()
     ps.enable()
-    time.sleep(1)
+    print(ps.wait_settled())
     ps.disable()
\ No newline at end of file
@@ -1,47 +1,75 @@
-import pyvisa
+from collections import OrderedDict
+from equipment import VisaResources
+
+class CarrierPlan(object):
+    '''Analyzer settings for measuring the carrier, as SCPI header: value in
+    the order they are sent. Create one per job (or per part number) and
+    pass it to get_carrier_stats; the analyzer only sends the settings that
+    differ from what it last sent.'''
+    def __init__(self, center = 433164000, span = 50000, rbw = 3000,
+                    attenuation = 0):
+        self.settings = OrderedDict([
+            (':INIT:CONT', 'ON'),
+            (':FREQ:CENT', '%d'%center),
+            # reject anything not seen on 
+            (':FREQ:SPAN', '%d'%span),
+            (':UNIT:POW', 'DBM'),
+            # Set the input attenuation (0dB by default)
+            (':POW:ATT', '%d'%attenuation),
+            # Kyle used 0.65 in PSS command line
+            #(':SENS:SWE:TIME', '2.222200E-02'),
+            # Kyle used 300 in PSS command line
+            (':BAND:RES', '%d'%rbw),
+            (':CALC:MARK1:CPE', 'ON'),
+            ])
 
 class SpectrumAnalyzer(object):
     def __init__(self):
         self.connected = False
+        # Resource name (or part of it, like the serial number) of the
+        # instrument to use when there is more than one connected
+        self.address = None
         self.name = 'Rigol DSA815 Spectrum Analyzer'
+        self.plan = CarrierPlan()
+        # Settings sent to the instrument since connecting, by any driver
+        # object using it
+        self.state = {}
 
     def connect(self):
-        rm = pyvisa.ResourceManager()
-        resources = rm.list_resources()
         id = '::0x1AB1::0x0960::' #DSA815 VID/PID
-        inst = [x for x in resources if id in x]
-        try:
-            self.comm = rm.get_instrument(inst[0])
-            self.get_id()
-            self.connected = True
-        except:
-            self.comm = None
-            self.connected = False
+        # Reuse the shared discovery and any session that is already open,
+        # using *IDN? as the liveness check
+        self.comm = VisaResources.connect(id, self.address)
+        self.connected = self.comm is not None
+        if self.connected:
+            # The instrument may have been reset or changed from the front 
+            # panel
+            self.state = VisaResources.session_state(self.comm)
+            self.state.clear()
         return self.connected
 
     def disconnect(self):
         self.comm = None
         self.connected = False
+        self.state = {}
 
     def get_id(self):
-        return self.comm.ask('*IDN?').strip()
-
-    def get_carrier_stats(self):
-        self.comm.write(':INIT:CONT ON')
-        self.comm.write(':FREQ:CENT 433164000')
-        # reject anything not seen on 
-        self.comm.write(':FREQ:SPAN 50000')
-        self.comm.write(':UNIT:POW DBM')
-        # Set the input attenuation to 0dB
-        self.comm.write(':POW:ATT 0')
-        # Kyle used 0.65 in PSS command line
-        #self.comm.write(':SENS:SWE:TIME 2.222200E-02')
-        # Kyle used 300 in PSS command line
-        self.comm.write(':BAND:RES 3000')
-        self.comm.write(':CALC:MARK1:CPE ON')
-        freq = int(self.comm.ask(':CALC:MARK1:X?'))
-        power = float(self.comm.ask(':CALC:MARK1:Y?'))
-        return (power, freq)
+        return self.comm.query('*IDN?').strip()
+
+    def apply(self, plan):
+        '''Send the plan's settings that aren't already set, in one write.'''
+        changed = [(header, value) for (header, value) in plan.settings.items()
+                    if self.state.get(header) != value]
+        if changed:
+            self.comm.write(';'.join('%s %s'%setting for setting in changed))
+            self.state.update(changed)
+
+    def get_carrier_stats(self, plan = None):
+        self.apply(plan or self.plan)
+        # Read both marker values in one round trip
+        resp = self.comm.query(':CALC:MARK1:X?;:CALC:MARK1:Y?').strip()
+        (freq, power) = resp.split(';')
+        return (float(power), int(float(freq)))
 
 if __name__ == '__main__':
     sa = SpectrumAnalyzer()
@@ -49,4 +77,4 @@ if __name__ == '__main__':
     print(sa.get_id())
     (pwr, freq) = sa.get_carrier_stats()
     print(pwr)
-    print(freq)
\ No newline at end of file
+    print(freq)
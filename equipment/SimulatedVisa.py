@@ -0,0 +1,220 @@
+import math
+import time
+import random
+import threading
+
+# Simulated SCPI instruments that stand in for pyvisa when the Keithley and
+# Rigol hardware is not on the bench. Each instrument answers the commands
+# that the drivers in this directory send, after a configurable latency and
+# with configurable measurement noise. Use it through
+# VisaResources.use_resource_manager(SimulatedVisa.ResourceManager()), or by
+# setting COMMISSIONING_SIMULATE_VISA=1 before starting the station.
+
+class SimulatedInstrument(object):
+    '''Base class for a simulated instrument session. Subclasses fill in
+    self.handlers with SCPI header -> function(args) and return a string
+    for queries.'''
+    idn = 'SIMULATED,INSTRUMENT,0,1.0'
+    vid_pid = '0x0000::0x0000'
+
+    def __init__(self, serial = '1', latency = 0.002, noise = 0.001):
+        self.serial = serial
+        # Seconds per round trip and relative standard deviation of readings
+        self.latency = latency
+        self.noise = noise
+        self.lock = threading.Lock()
+        self.response = ''
+        self.handlers = {'*IDN?': lambda args: self.idn}
+        self.writes = 0
+
+    @property
+    def resource_name(self):
+        return 'USB0::%s::%s::INSTR'%(self.vid_pid, self.serial)
+
+    def noisy(self, value):
+        return random.gauss(value, abs(value)*self.noise)
+
+    def execute(self, command):
+        '''Run one or more ';' separated commands and return the joined
+        responses of the queries.'''
+        responses = []
+        for cmd in command.strip().split(';'):
+            cmd = cmd.strip()
+            if not cmd:
+                continue
+            (header, _, args) = cmd.partition(' ')
+            header = header.upper()
+            if header not in self.handlers:
+                raise self.Error('Undefined header: %s'%cmd)
+            resp = self.handlers[header](args.strip())
+            if header.endswith('?'):
+                responses.append(str(resp))
+        return ';'.join(responses)
+
+    def write(self, command):
+        with self.lock:
+            time.sleep(self.latency)
+            self.writes += 1
+            self.response = self.execute(command)
+
+    def read(self):
+        with self.lock:
+            resp = self.response
+            self.response = ''
+            return resp + '\n'
+
+    def query(self, command):
+        with self.lock:
+            time.sleep(self.latency)
+            self.writes += 1
+            return self.execute(command) + '\n'
+
+    def close(self):
+        pass
+
+    class Error(Exception):
+        pass
+
+class Keithley2110(SimulatedInstrument):
+    idn = 'KEITHLEY INSTRUMENTS INC.,MODEL 2110,SIM0001,1.0'
+    vid_pid = '0x05E6::0x2110'
+
+    def __init__(self, current = 0.012, **kwargs):
+        SimulatedInstrument.__init__(self, **kwargs)
+        self.current = current
+        self.sample_count = 1
+        self.handlers.update({
+            # Like the meter, CONF resets the sample count
+            ':CONF:CURR': lambda args: setattr(self, 'sample_count', 1),
+            ':MEAS:CURR?': lambda args: '%e'%self.noisy(self.current),
+            ':READ?': self.read_buffer,
+            ':TRIG:SOUR': lambda args: None,
+            ':TRIG:COUN': lambda args: None,
+            ':SAMP:COUN': lambda args: setattr(self, 'sample_count', 
+                                                int(args)),
+            ':CURR:DC:NPLC': lambda args: None,
+            })
+
+    def read_buffer(self, args):
+        return ','.join('%e'%self.noisy(self.current) 
+                        for n in range(self.sample_count))
+
+class PowerSupply(SimulatedInstrument):
+    '''Shared output model for the simulated power supplies.'''
+    def __init__(self, load = 100.0, rise_time = 0.005, **kwargs):
+        SimulatedInstrument.__init__(self, **kwargs)
+        # Resistive load (ohms) on the output, and the time constant (s) of
+        # the output moving to a new setting
+        self.load = load
+        self.rise_time = rise_time
+        self.current_limit = 1.0
+        self.output = False
+        self.target = 0.0
+        self.start_voltage = 0.0
+        self.changed = time.time()
+
+    @property
+    def voltage(self):
+        return self.target
+
+    @voltage.setter
+    def voltage(self, voltage):
+        self.start_voltage = self.output_voltage()
+        self.target = voltage
+        self.changed = time.time()
+
+    def set_output(self, state):
+        self.start_voltage = self.output_voltage()
+        self.output = state.upper() in ['ON', '1']
+        self.changed = time.time()
+
+    def output_voltage(self):
+        final = min(self.target, self.current_limit*self.load) \
+                    if self.output else 0.0
+        decay = math.exp(-(time.time() - self.changed)/self.rise_time)
+        return final + (self.start_voltage - final)*decay
+
+    def measured_voltage(self):
+        return self.noisy(self.output_voltage())
+
+    def measured_current(self):
+        return self.measured_voltage()/self.load
+
+class Keithley2200(PowerSupply):
+    idn = 'Keithley instruments, 2200-30-5, SIM0002, 1.0'
+    vid_pid = '0x05E6::0x2200'
+
+    def __init__(self, **kwargs):
+        PowerSupply.__init__(self, **kwargs)
+        self.handlers.update({
+            ':VOLT': lambda args: setattr(self, 'voltage', float(args)),
+            ':CURR': lambda args: setattr(self, 'current_limit', float(args)),
+            ':OUTP': self.set_output,
+            ':MEAS:VOLT?': lambda args: '%f'%self.measured_voltage(),
+            ':MEAS:CURR?': lambda args: '%f'%self.measured_current(),
+            })
+
+class RigolDP832(PowerSupply):
+    idn = 'RIGOL TECHNOLOGIES,DP832,SIM0003,00.01.14'
+    vid_pid = '0x1AB1::0x0E11'
+
+    def __init__(self, **kwargs):
+        PowerSupply.__init__(self, **kwargs)
+        self.handlers.update({
+            ':APPL': self.apply,
+            ':OUTP': lambda args: self.set_output(args.split(',')[-1]),
+            ':MEAS:VOLT?': lambda args: '%f'%self.measured_voltage(),
+            ':MEAS:CURR?': lambda args: '%f'%self.measured_current(),
+            ':MEAS:ALL?': self.measure_all,
+            })
+
+    def measure_all(self, args):
+        voltage = self.measured_voltage()
+        current = voltage/self.load
+        return '%f,%f,%f'%(voltage, current, voltage*current)
+
+    def apply(self, args):
+        # Only channel 3 is simulated: CH3,<volts>,<amps>
+        (channel, voltage, current) = args.split(',')
+        self.voltage = float(voltage)
+        self.current_limit = float(current)
+
+class RigolDSA815(SimulatedInstrument):
+    idn = 'Rigol Technologies,DSA815,SIM0004,00.01.12.00.02'
+    vid_pid = '0x1AB1::0x0960'
+
+    def __init__(self, carrier_freq = 433164000, carrier_power = -20.0,
+                    **kwargs):
+        SimulatedInstrument.__init__(self, **kwargs)
+        self.carrier_freq = carrier_freq
+        self.carrier_power = carrier_power
+        self.settings = {}
+        setting = lambda header: (lambda args:
+                                        self.settings.update({header: args}))
+        for header in [':INIT:CONT', ':FREQ:CENT', ':FREQ:SPAN', ':UNIT:POW',
+                        ':POW:ATT', ':BAND:RES', ':CALC:MARK1:CPE']:
+            self.handlers[header] = setting(header)
+        self.handlers.update({
+            ':CALC:MARK1:X?': lambda args: '%d'%self.carrier_freq,
+            ':CALC:MARK1:Y?': lambda args:
+                                    '%f'%self.noisy(self.carrier_power),
+            })
+
+class ResourceManager(object):
+    '''Stands in for pyvisa.ResourceManager with one of each simulated
+    instrument (or the given list of instruments).'''
+    def __init__(self, instruments = None, latency = 0.002, noise = 0.001,
+                    scan_latency = 0.0):
+        if instruments is None:
+            instruments = [cls(latency = latency, noise = noise) for cls in
+                    [Keithley2110, Keithley2200, RigolDP832, RigolDSA815]]
+        self.instruments = {inst.resource_name: inst for inst in instruments}
+        # Seconds taken by list_resources (a real USB scan takes seconds)
+        self.scan_latency = scan_latency
+
+    def list_resources(self):
+        time.sleep(self.scan_latency)
+        return tuple(self.instruments)
+
+    def open_resource(self, resource):
+        return self.instruments[resource]
@@ -0,0 +1,51 @@
+import time
+
+# Shared by the power supply drivers: instead of sleeping for a fixed time
+# after changing the output, poll the measured voltage and current and
+# return as soon as the rail has stopped moving.
+
+def wait_settled(measure, setpoint = None, current_limit = None, 
+                    tolerance = 0.01, timeout = 2.0, interval = 0.01, 
+                    readings = 3, current_floor = 0.001, voltage_floor = 0.01,
+                    sleep = time.sleep):
+    '''Polls measure() -> (voltage, current) until readings consecutive
+    measurements agree within tolerance (relative, with current_floor amps
+    and voltage_floor volts as the smallest steps that count, so that an
+    output that is off settles), and the voltage is within tolerance of the
+    setpoint when one is given (unless the supply is in current limit). 
+    Returns the last (voltage, current), or raises TimeoutError after 
+    timeout seconds. sleep waits between readings (a test's sleep, so that
+    the wait stops when the test is cancelled).'''
+    deadline = time.time() + timeout
+    history = []
+    while True:
+        (voltage, current) = measure()
+        history = history[-(readings - 1):] + [(voltage, current)]
+        if len(history) == readings and settled(history, setpoint, 
+                    current_limit, tolerance, current_floor, voltage_floor):
+            return (voltage, current)
+        if time.time() + interval > deadline:
+            raise TimeoutError('Supply did not settle in %.1fs: %.3fV %.4fA'%(
+                                                timeout, voltage, current))
+        sleep(interval)
+
+def settled(history, setpoint, current_limit, tolerance, current_floor, 
+                voltage_floor):
+    voltages = [v for (v, i) in history]
+    currents = [i for (v, i) in history]
+    v_band = max(tolerance*max(abs(v) for v in voltages), voltage_floor)
+    i_band = max(tolerance*max(abs(i) for i in currents), current_floor)
+    if max(voltages) - min(voltages) > v_band:
+        return False
+    if max(currents) - min(currents) > i_band:
+        return False
+    # A rail still ramping slowly looks stable from reading to reading, so
+    # also check that it has reached the setpoint (which it won't in 
+    # current limit)
+    if current_limit is not None and \
+                        currents[-1] >= (1 - tolerance)*current_limit:
+        return True
+    if setpoint is not None and abs(voltages[-1] - setpoint) > \
+                                            tolerance*abs(setpoint):
+        return False
+    return True
@@ -0,0 +1,120 @@
+import os
+import sys
+import threading
+
+# A single ResourceManager and a single instrument discovery shared by every
+# VISA driver in the program. Enumerating the USB instruments takes seconds,
+# so the list is only refreshed when a lookup misses. Instrument sessions are
+# kept open across jobs and part number changes (new driver objects reuse
+# the session that is already open), along with what the drivers last set 
+# on each instrument.
+#
+# Set COMMISSIONING_SIMULATE_VISA=1 to use the simulated instruments in
+# SimulatedVisa instead of the hardware.
+
+_lock = threading.RLock()
+_rm = None
+_resources = None
+_sessions = {}
+_states = {}
+
+def get_resource_manager():
+    global _rm
+    with _lock:
+        if _rm is None:
+            if os.environ.get('COMMISSIONING_SIMULATE_VISA', '0') != '0':
+                from equipment import SimulatedVisa
+                _rm = SimulatedVisa.ResourceManager()
+            else:
+                # pyvisa (and its backend) is only loaded once an instrument
+                # is used
+                import pyvisa
+                _rm = pyvisa.ResourceManager()
+        return _rm
+
+def use_resource_manager(rm):
+    '''Replace the ResourceManager (with SimulatedVisa.ResourceManager, for
+    example), dropping the cached discovery and sessions.'''
+    global _rm, _resources
+    with _lock:
+        _rm = rm
+        _resources = None
+        _sessions.clear()
+        _states.clear()
+
+def find_resources(id, address = None, refresh = False):
+    '''Returns the resource names containing id (and address, if given)
+    from the cached discovery, rescanning when asked to or when nothing
+    matches.'''
+    global _resources
+    def matches():
+        inst = [x for x in _resources if id in x]
+        if address is not None:
+            inst = [x for x in inst if address in x]
+        return inst
+    with _lock:
+        scanned = False
+        if _resources is None or refresh:
+            _resources = tuple(get_resource_manager().list_resources())
+            scanned = True
+        inst = matches()
+        if not inst and not scanned:
+            _resources = tuple(get_resource_manager().list_resources())
+            inst = matches()
+        return inst
+
+def open_instrument(resource):
+    '''Returns the open session for the resource, opening it if needed.'''
+    with _lock:
+        if resource not in _sessions:
+            _sessions[resource] = get_resource_manager().open_resource(resource)
+        return _sessions[resource]
+
+def forget_instrument(resource):
+    '''Close a session that stopped responding (unplugged or power cycled)
+    so that the next connect opens a new one.'''
+    global _resources
+    with _lock:
+        comm = _sessions.pop(resource, None)
+        _states.pop(resource, None)
+        # The instrument may have come back with a different resource name
+        _resources = None
+    if comm is not None:
+        try:
+            comm.close()
+        except Exception:
+            pass
+
+def session_state(comm):
+    '''Returns the dictionary the drivers use to remember the settings they
+    last sent to the instrument. It belongs to the session, so every driver
+    object using the instrument sees the same settings.'''
+    with _lock:
+        return _states.setdefault(comm.resource_name, {})
+
+def io_errors():
+    '''Returns the exceptions that mean an instrument can't be talked to
+    (pyvisa's errors are only included once pyvisa has been loaded).'''
+    errors = (OSError,)
+    pyvisa = sys.modules.get('pyvisa')
+    if pyvisa is not None:
+        errors += (pyvisa.errors.Error,)
+    return errors
+
+def connect(id, address = None, query = '*IDN?'):
+    '''Returns a live session to the first instrument matching id (and
+    address), or None. The query is used as the liveness check.'''
+    resources = find_resources(id, address)
+    for attempt in range(2):
+        for resource in resources:
+            try:
+                comm = open_instrument(resource)
+                comm.query(query)
+                return comm
+            except io_errors():
+                forget_instrument(resource)
+        if not resources:
+            break
+        # Every match was stale, so rescan once in case it was replugged
+        resources = find_resources(id, address, refresh = True)
+    return None
@@ -0,0 +1,40 @@
+import os
+import time
+import threading
+import traceback
+
+# Errors that the program carries on from (a background thread catching an
+# exception) are appended to the same file as the ones that end it, since
+# nothing that is printed is seen in the --noconsole build.
+
+default_filename = 'logs/ProgramError.log'
+_lock = threading.Lock()
+# The last error written by each thread
+_last = {}
+
+def write_error(filename = default_filename):
+    '''Appends the exception being handled to the error file (and prints
+    it), with the time and the thread it happened in. A thread that keeps
+    hitting the same error (a reader that stays unplugged) only writes it
+    once.'''
+    text = traceback.format_exc()
+    print(text)
+    header = time.strftime('%Y-%m-%d %H:%M:%S')
+    thread = threading.current_thread()
+    if thread is not threading.main_thread():
+        header += ' (%s)'%thread.name
+    with _lock:
+        if _last.get(thread.ident) == text:
+            return
+        _last[thread.ident] = text
+        try:
+            # Ensure that the logs directory exists
+            dir = os.path.dirname(filename)
+            if dir and not os.path.exists(dir):
+                os.makedirs(dir)
+            with open(filename, 'a') as err_file:
+                err_file.write('-'*79 + '\n' + header + '\n' + '-'*79 + '\n')
+                err_file.write(text)
+        except OSError:
+            # Nowhere left to report it
+            pass
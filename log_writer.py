@@ -0,0 +1,135 @@
+import os
+import atexit
+import threading
+import queue as Queue
+import error_log
+
+class LogWriter(object):
+    '''Writes log files from a background thread so that the test threads
+    never wait on the disk. Each file is opened once and kept open until it
+    is closed, and everything queued while the writer was busy is written
+    in a single batch.
+
+    Flush policies (per file):
+        'batch' - flush to the OS after every batch (the default)
+        'close' - only flush when the file is closed, or when the program
+                  exits normally (opt in: a hard crash loses everything
+                  written since the file was opened)
+    With fsync enabled, every flush is also synced to the disk (survives a
+    power failure, at the cost of a disk write per batch).
+
+    Lines are queued before they are written, so an exit that skips the
+    atexit flush (the process being killed, or a crash of the interpreter)
+    loses the lines still in the queue. With the 'batch' policy that is 
+    only what was logged while the writer was busy with the previous batch,
+    normally milliseconds' worth. A procedure waits for flush() after 
+    closing a run's log, so a run recorded as ended has its whole log.
+
+    Writes to a file after it has been closed (a late line from a test that
+    missed its deadline) are dropped, until the file is opened again.'''
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.files = {}
+        self.policies = {}
+        # Files that have been closed and not opened again
+        self.closed = set()
+        self.thread = threading.Thread(target = self.run,
+                                        name = 'LogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+        # Drain the queue before the interpreter exits (including exits
+        # through write_error_file) so that no lines are lost
+        atexit.register(self.flush)
+
+    def open(self, filename, flush = 'batch', fsync = False):
+        assert flush in ['batch', 'close'], 'Invalid flush policy: ' + flush
+        self.queue.put(('open', filename, (flush, fsync)))
+
+    def write(self, filename, data):
+        self.queue.put(('write', filename, data))
+
+    def close(self, filename):
+        self.queue.put(('close', filename, None))
+
+    def flush(self, timeout = 5):
+        '''Block until everything queued so far has been written.'''
+        done = threading.Event()
+        self.queue.put(('flush', None, done))
+        return done.wait(timeout)
+
+    def run(self):
+        while True:
+            # Block until there is something to do, then take everything
+            # else that has been queued in the meantime
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception:
+                # Never let a bad file stop the logging for everyone else
+                error_log.write_error()
+
+    def write_batch(self, batch):
+        pending = {}
+        waiting = []
+        for (action, filename, arg) in batch:
+            if action == 'open':
+                self.policies[filename] = arg
+                self.closed.discard(filename)
+            elif action == 'write':
+                pending.setdefault(filename, []).append(arg)
+            elif action == 'close':
+                # Write anything still pending before closing
+                self.write_lines(filename, pending.pop(filename, []))
+                self.close_file(filename)
+            elif action == 'flush':
+                waiting.append(arg)
+        for (filename, lines) in pending.items():
+            self.write_lines(filename, lines)
+            if self.policies.get(filename, ('batch', False))[0] == 'batch':
+                self.flush_file(filename)
+        for done in waiting:
+            for filename in list(self.files):
+                self.flush_file(filename)
+            done.set()
+
+    def write_lines(self, filename, lines):
+        if not lines or filename in self.closed:
+            return
+        if filename not in self.files:
+            # Ensure that the logs directory exists
+            dir = os.path.dirname(filename)
+            if dir and not os.path.exists(dir):
+                os.makedirs(dir)
+            self.files[filename] = open(filename, 'a')
+        self.files[filename].write(''.join(lines))
+
+    def flush_file(self, filename):
+        if filename not in self.files:
+            return
+        ofile = self.files[filename]
+        ofile.flush()
+        if self.policies.get(filename, ('batch', False))[1]:
+            os.fsync(ofile.fileno())
+
+    def close_file(self, filename):
+        if filename in self.files:
+            self.flush_file(filename)
+            self.files.pop(filename).close()
+        self.policies.pop(filename, None)
+        self.closed.add(filename)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    '''Returns the log writer shared by every procedure in the program.'''
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter()
+        return _writer
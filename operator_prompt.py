@@ -0,0 +1,64 @@
+import threading
+
+class OperatorRequest(object):
+    '''A question for the operator. The test thread blocks in wait() on an
+    Event (using no CPU) until the GUI calls respond(), or until the timeout
+    passes and the default is used instead.
+
+    kind is one of:
+        'pass_fail' - respond with 'pass' or 'fail'
+        'number'    - respond with a float
+        'barcode'   - respond with the scanned (or typed) string
+    message is a tuple of translations, like the test names.'''
+    kinds = ['pass_fail', 'number', 'barcode']
+
+    def __init__(self, kind, message, timeout = None, default = None):
+        assert kind in self.kinds, 'Unknown operator request: %s'%kind
+        self.kind = kind
+        self.message = message
+        self.timeout = timeout
+        self.default = default
+        self.value = default
+        self.timed_out = False
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+
+    @property
+    def answered(self):
+        return self.event.is_set()
+
+    # Thread safe
+    def respond(self, value):
+        '''Answer the request. Only the first answer counts.'''
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.value = value
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def cancel(self):
+        '''Answer with the default (the test is being stopped).'''
+        self.respond(self.default)
+
+    def add_callback(self, callback):
+        '''Call callback (from whichever thread answers) once the request
+        has been answered or has timed out, to close the dialog.'''
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self):
+        '''Block until answered, returning the answer (or the default when
+        the timeout passes first).'''
+        if not self.event.wait(self.timeout):
+            with self.lock:
+                self.timed_out = not self.event.is_set()
+            self.cancel()
+        return self.value
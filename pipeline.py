@@ -0,0 +1,225 @@
+import time
+import queue
+import threading
+import error_log
+
+# Runs consecutive DUTs through a procedure's stages at the same time, so
+# that (for example) one DUT is being identified while the one before it is
+# being tested and the one before that is being commissioned. A procedure
+# lists its stages in order, and each test names the stage it belongs to:
+#
+#   class Procedure(object):
+#       stages = [Stage('identify', ['rfid', 'scanner']),
+#               Stage('test', ['power', 'dmm']),
+#               Stage('commission', ['rfid'])]
+#
+# Each stage has its own thread and works on one DUT at a time, each DUT
+# having its own Procedure (log, results and test states) sharing the
+# equipment. A stage holds the equipment it lists while it works on a DUT,
+# so stages that share an instrument (the RFID reader above) take turns
+# with it; equipment that only one stage lists is that stage's alone. A
+# stage's tests only see the equipment their stage lists, so a test can't
+# use an instrument that another stage may be using. A DUT that is stopped
+# (fail(exit = True), or stop()) skips the rest of the stages.
+#
+# The station runs a part number's DUTs through the pipeline when its
+# configuration sets [pipeline] depth. A stage whose tests have not all
+# called back after stage_timeout seconds (600 by default, 0 for none), or
+# stop_timeout seconds (10) after its DUT was stopped, gives up on them and
+# stops the DUT so that its equipment is not held forever:
+#
+#   [pipeline]
+#   depth = 1
+#   stage_timeout = 600
+#   stop_timeout = 10
+
+class Stage(object):
+    '''A stage of a procedure: the name its tests give as their stage, and
+    the keys of the equipment the stage uses.'''
+    def __init__(self, name, resources = ()):
+        self.name = name
+        self.resources = tuple(resources)
+
+class StageEquipment(dict):
+    '''The equipment a stage lists, given to the DUT's tests while the
+    stage works on it.'''
+    def __init__(self, stage, equipment):
+        super(StageEquipment, self).__init__((key, equipment[key]) 
+                                                for key in stage.resources)
+        self.stage = stage
+
+    def __missing__(self, key):
+        raise KeyError('%s is not listed in the resources of stage %s'%(key,
+                                                            self.stage.name))
+
+class Pipeline(object):
+    '''Runs the procedure's stages, each on a different DUT. depth is the
+    number of DUTs that may wait for each stage.'''
+    def __init__(self, parent, procedure, depth = 1, done_callback = None,
+                stage_callback = None):
+        self.parent = parent
+        self.procedure = procedure
+        # Called with each DUT's Procedure once its run has ended
+        self.done_callback = done_callback
+        # Called (from the stage's thread) with a DUT's Procedure and the
+        # stage's index as the stage starts working on it
+        self.stage_callback = stage_callback
+        self.stages = list(procedure.stages)
+        config = procedure.config
+        self.stage_timeout = config.getfloat('pipeline', 'stage_timeout', 
+                                            fallback = 600)
+        self.stop_timeout = config.getfloat('pipeline', 'stop_timeout', 
+                                            fallback = 10)
+        self.stage_tests = self.split_tests()
+        self.resource_locks = {}
+        for stage in self.stages:
+            for key in stage.resources:
+                self.resource_locks.setdefault(key, threading.Lock())
+        self.queues = [queue.Queue(maxsize = depth) for stage in self.stages]
+        self.threads = []
+        # The Procedures of the DUTs in the pipeline
+        self.contexts = []
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def split_tests(self):
+        '''Returns the procedure's test classes for each stage. Tests
+        without a stage belong to the first. Raises ValueError if a test
+        has a prerequisite in a later stage.'''
+        index = dict((stage.name, n) for (n, stage) in enumerate(self.stages))
+        (test_classes, prerequisites) = self.procedure.get_registry()
+        stage_tests = [[] for stage in self.stages]
+        test_stage = {}
+        for (id, TestClass) in test_classes.items():
+            if TestClass.stage is None:
+                n = 0
+            elif TestClass.stage in index:
+                n = index[TestClass.stage]
+            else:
+                raise ValueError('Test %s has an unknown stage: %s'%(id,
+                                                            TestClass.stage))
+            stage_tests[n].append(TestClass)
+            test_stage[id] = n
+        for (id, required) in prerequisites.items():
+            for other in required:
+                if test_stage[other] > test_stage[id]:
+                    raise ValueError('Test %s requires %s from a later '
+                                        'stage'%(id, other))
+        return stage_tests
+
+    def start(self):
+        '''Connects the equipment (raising the procedure's EquipmentFailure)
+        and starts the stages.'''
+        self.procedure.connect_equipment()
+        for (n, stage) in enumerate(self.stages):
+            thread = threading.Thread(target = self.run_stage, args = (n,),
+                                        name = 'Stage %s'%stage.name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def feed(self, trigger_value = None):
+        '''Starts the run of a new DUT, blocking while the first stage is
+        full. Returns the DUT's Procedure.'''
+        context = self.procedure.new_context(self.parent)
+        context.trigger_value = trigger_value
+        with self.lock:
+            self.contexts.append(context)
+        context.begin_run(connect = False)
+        self.queues[0].put(context)
+        return context
+
+    def ready(self):
+        '''Returns True if the first stage can take another DUT without
+        feed blocking (when only one thread feeds the pipeline).'''
+        return not self.queues[0].full()
+
+    def run_stage(self, n):
+        last = n == len(self.stages) - 1
+        while True:
+            context = self.queues[n].get()
+            if context is None:
+                break
+            if not context.stopped:
+                self.run_tests(context, n)
+            if context.stopped or last:
+                self.finish(context)
+            else:
+                self.queues[n + 1].put(context)
+
+    def run_tests(self, context, n):
+        '''Runs stage n's tests on the DUT, holding the stage's equipment
+        until they have finished.'''
+        stage = self.stages[n]
+        # Always take the locks in the same order so stages can't deadlock
+        locks = [self.resource_locks[key] for key in sorted(stage.resources)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            context.equipment = StageEquipment(stage, 
+                                                self.procedure.equipment)
+            if self.stage_callback is not None:
+                self.stage_callback(context, n)
+            finished = threading.Event()
+            context.start_tests(self.stage_tests[n],
+                                callback = lambda no_failures: finished.set())
+            self.wait_tests(context, stage, finished)
+        except Exception:
+            error_log.write_error()
+            context.stop()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def wait_tests(self, context, stage, finished):
+        '''Waits for the stage's tests to call back, giving up on them after
+        the stage or stop timeout.'''
+        start = time.time()
+        stopped_time = None
+        while not finished.wait(0.1):
+            now = time.time()
+            if context.stopped and stopped_time is None:
+                stopped_time = now
+            if self.stage_timeout and now - start > self.stage_timeout:
+                reason = 'stage %s timed out after %ds'%(stage.name, 
+                                                        self.stage_timeout)
+            elif stopped_time is not None and \
+                                    now - stopped_time > self.stop_timeout:
+                reason = 'still running %ds after the stop'%self.stop_timeout
+            else:
+                continue
+            context.abandon_tests(reason)
+            return
+
+    def finish(self, context):
+        try:
+            context.end_run()
+            if self.done_callback is not None:
+                self.done_callback(context)
+        except Exception:
+            error_log.write_error()
+        with self.lock:
+            self.contexts.remove(context)
+            self.idle.notify_all()
+
+    def stop(self):
+        '''Stops every DUT in the pipeline.'''
+        with self.lock:
+            contexts = list(self.contexts)
+        for context in contexts:
+            context.stop()
+
+    def wait_idle(self, timeout = None):
+        '''Waits for every DUT fed so far to finish. Returns False if the
+        timeout passed first.'''
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.contexts, timeout)
+
+    def close(self, timeout = None):
+        '''Lets the DUTs in the pipeline finish, then ends the stages.'''
+        self.wait_idle(timeout)
+        for stage_queue in self.queues:
+            stage_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
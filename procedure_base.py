@@ -0,0 +1,761 @@
+from collections import OrderedDict
+import time
+import threading
+import traceback
+import uuid
+import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
+import log_writer
+import results_store
+import step_timing
+from operator_prompt import OperatorRequest
+from pipeline import Stage
+
+# The test sequencing shared by every procedure module: the TestThread each
+# test subclasses and the Procedure that schedules the tests, logs and 
+# records the runs and connects the equipment. A procedure module only 
+# declares its tests and a Procedure subclass listing them:
+#
+#   class Procedure(procedure_base.Procedure):
+#       title = 'Widget Commissioning 1.0'
+#       test_classes = [ScanLabel, CheckCurrent, WriteTag]
+#       verify_class = Verify
+
+def isolated_worker(conn, func, args):
+    '''Runs func in the worker process started by TestThread.run_isolated
+    and sends back (True, result) or (False, exception).'''
+    try:
+        conn.send((True, func(*args)))
+    except Exception as e:
+        try:
+            conn.send((False, e))
+        except Exception:
+            # The exception can't be pickled
+            conn.send((False, RuntimeError(repr(e))))
+
+class TestThread(threading.Thread):
+    # Each test declares its metadata here, at class level, so that the
+    # procedure can list the tests without creating their threads:
+    #   id - unique within the procedure
+    #   trans - the (English, Chinese) names shown to the operator
+    #   exp_time - expected seconds, or None when it can't be predicted (a
+    #       test waiting on the operator)
+    id = ''
+    trans = ('', '')
+    exp_time = None
+    # Ids of the tests that must finish (pass or fail) before this test is
+    # started. None means every test listed before this one in the
+    # procedure's test_classes, which runs the tests one after another.
+    requires = None
+    # Whether missing the deadline aborts the rest of the tests, like
+    # fail(exit = True), or lets them continue like fail(exit = False)
+    timeout_exit = True
+    # Name of the procedure's stage the test belongs to when the DUTs are
+    # pipelined (see pipeline), None for the first stage
+    stage = None
+
+    def __init__(self, parent):
+        super(TestThread, self).__init__()
+        self.daemon = True
+        self.parent = parent
+        self.log = self.parent.log
+        self.name = self.trans[0]
+        self.message = ''
+
+        # Set by the procedure's watchdog when the test misses its deadline
+        self.timed_out = False
+        self.cancelled = threading.Event()
+        self.deadline_time = None
+        self.state = 'pending' #'running', 'pass', 'fail'
+        self.data = ''
+        self.start_time = None
+        self.end_time = None
+        # When the test was queued (at the start of the run) and the time 
+        # spent in equipment calls (see step_timing.TimedEquipment)
+        self.queued_time = None
+        self.io_time = 0.0
+
+    def run(self):
+        try:
+            callback = self.parent.test_callback
+            if self.id == 'verify':
+                callback = self.parent.verify_callback
+            self.state = 'running'
+            self.start_time = time.time()
+            callback(self)
+            self.parent.wait_for_trigger()
+            self.test_procedure()
+            self.end_time = time.time()
+            callback(self)
+        except self.Cancelled:
+            # The watchdog has already failed this test
+            pass
+        except Exception as e:
+            if self.timed_out:
+                # Nobody is waiting on this test any more
+                return
+            self.state = 'fail'
+            if self.end_time is None:
+                self.end_time = time.time()
+            self.parent.thread_exception(self, e)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        # Once the watchdog has failed the test, the thread (which may still
+        # be running) can't change the result
+        if not self.timed_out:
+            self._state = state
+
+    def test_procedure(self):
+        # Threads cannot be killed cleanly in Python, so the procedure's 
+        # watchdog fails the test at its deadline and cancels it. Tests 
+        # should wait using self.sleep() (or check self.check_cancelled())
+        # so that they stop promptly, and run calls that can hang with 
+        # self.run_isolated() so that they can be killed.
+        pass
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise self.Cancelled()
+
+    def sleep(self, seconds):
+        '''time.sleep() that ends early (raising Cancelled) when the test
+        is cancelled.'''
+        if self.cancelled.wait(seconds):
+            raise self.Cancelled()
+
+    def run_isolated(self, func, *args):
+        '''Runs func(*args) in a worker process that is killed if it is 
+        still running at this test's deadline. func, args and the return 
+        value must be picklable (func must be a module level function).'''
+        (recv, send) = multiprocessing.Pipe(duplex = False)
+        process = multiprocessing.Process(target = isolated_worker,
+                                        args = (send, func, args))
+        process.daemon = True
+        process.start()
+        send.close()
+        timeout = None
+        if self.deadline_time is not None:
+            timeout = max(0, self.deadline_time - time.time())
+        if not multiprocessing.connection.wait([recv, process.sentinel], 
+                                                timeout):
+            # The deadline has passed (the watchdog fails the test)
+            process.terminate()
+            process.join()
+            raise self.Cancelled()
+        try:
+            (ok, result) = recv.recv()
+        except EOFError:
+            # The worker died without answering (a crash or os._exit), which
+            # fails the test like any other exception
+            process.join()
+            raise RuntimeError('Isolated worker exited with code %s'%
+                                process.exitcode)
+        process.join()
+        if not ok:
+            raise result
+        return result
+
+    def ask_operator(self, kind, message, timeout = None, default = None):
+        '''Ask the operator a question (see OperatorRequest), blocking this
+        test until it is answered or the timeout passes.'''
+        request = OperatorRequest(kind, message, timeout, default)
+        return self.parent.operator_query(request)
+
+    def pass_fail_query(self, message, timeout = None, default = 'fail'):
+        return self.ask_operator('pass_fail', message, timeout, default)
+
+    def number_query(self, message, timeout = None, default = None):
+        return self.ask_operator('number', message, timeout, default)
+
+    def barcode_query(self, message, timeout = None, default = ''):
+        return self.ask_operator('barcode', message, timeout, default)
+
+    def fail(self, message = '', exit = True):
+        if message != '':
+            self.log(message)
+        self.state = 'fail'
+        if exit:
+            # Abort the rest of the tests when this fails
+            self.parent.stop()
+
+    class Cancelled(Exception):
+        pass
+
+class Procedure(object):
+    '''Runs a procedure's tests on one DUT at a time. Each procedure module
+    subclasses it (as Procedure), setting the class attributes below.'''
+    # Logged at the start of every run
+    title = ''
+    # The tests in the order they are listed
+    test_classes = []
+    # The stages (and the equipment each one uses) that the tests are split
+    # into when the DUTs are pipelined, in order (see pipeline)
+    stages = [Stage('test')]
+    # The TestThread class run by verify_start
+    verify_class = None
+
+    def __init__(self, parent, config):
+        self.parent = parent
+        self.config = config
+
+        self.verify_callback = parent.verify_callback
+        
+        self.equipment = {}
+        # The EPC or barcode that triggered the run (see triggers), if any
+        self.trigger_value = None
+        # The trigger watching the fixture, whose poll in progress the tests
+        # wait for (see wait_for_trigger)
+        self.trigger = None
+
+        # Scheduler state, shared by the test threads
+        self.lock = threading.RLock()
+        self.pending_tests = []
+        self.running_tests = []
+        self.finished_tests = {}
+        self.watchdogs = {}
+        # Called instead of ending the run when the tests given to 
+        # start_tests have finished (see pipeline)
+        self.tests_callback = None
+        # Set by the one thread that ends the tests given to start_tests
+        self.finishing = False
+        self.stopped = False
+        # Operator requests that have not been answered yet
+        self.operator_requests = []
+        # Equipment key: the future of its last connect, which may still be
+        # running after timing out (see connect_equipment)
+        self.connecting = {}
+
+    @classmethod
+    def get_registry(cls):
+        '''Returns (OrderedDict of test id: test class, prerequisites of 
+        each test id), collected from the class level metadata of the tests
+        the first time it is needed.'''
+        # Each subclass collects its own
+        if '_registry' not in cls.__dict__:
+            test_classes = OrderedDict((TestClass.id, TestClass)
+                                        for TestClass in cls.test_classes)
+            cls._registry = (test_classes, 
+                            cls.get_prerequisites(cls.test_classes))
+        return cls._registry
+
+    def get_tests(self):
+        test_names = OrderedDict()
+        for (id, TestClass) in self.get_registry()[0].items():
+            test_names[id] = TestClass.trans
+        return test_names
+
+    def verify_start(self):
+        self.connect_equipment()
+        verify = self.verify_class(self)
+        verify.start()
+        return verify
+
+    def test_start(self):
+        self.begin_run()
+        self.start_tests(self.test_classes)
+
+    def new_context(self, parent):
+        '''Returns another Procedure, sharing this one's configuration and
+        equipment, to run a DUT alongside this one's (see pipeline).'''
+        context = self.__class__(parent, self.config)
+        context.equipment = self.equipment
+        return context
+
+    def begin_run(self, connect = True):
+        '''Starts the log and results of a run on a new DUT, connecting the
+        equipment unless the caller has already (see pipeline).'''
+        # Clear any leftover test data
+        self.uid = ''
+        self.test_log_buffer = []
+        self.log_filename = None
+        self.start_time = time.time()
+        start_time_local = time.localtime(self.start_time)
+        self.log_time_str = time.strftime('%Y-%m-%d_%H-%M-%S', start_time_local)
+        # How hard the log writer should try to get each line onto the disk
+        self.log_flush = self.config.get('log', 'flush', fallback = 'batch')
+        self.log_fsync = self.config.getboolean('log', 'fsync', 
+                                                fallback = False)
+        self.no_failures = True
+        # Log the test parameters
+        self.param_dict = dict(self.config.items('uservars'))
+        params = ['Part Number = %s'%self.param_dict['partnum']]
+        if self.config.has_section('fixture'):
+            params.append('Fixture = %s'%self.config.get('fixture', 'name'))
+        if self.trigger_value not in [None, True]:
+            params.append('Trigger = %s'%self.trigger_value)
+        self.log(self.parent.get_version_string())
+        self.log(self.title)
+        self.log(', '.join(params))
+        # Record the run in the results database
+        self.run_id = uuid.uuid4().hex
+        self.stored_uid = ''
+        fixture = self.config.get('fixture', 'name', fallback = None)
+        self.results = results_store.get_store()
+        self.durations = step_timing.get_durations()
+        self.results.start_run(self.run_id, self.param_dict['partnum'], 
+                        fixture, self.title, self.parent.get_version_string(), 
+                        self.start_time)
+        self.stopped = False
+        with self.lock:
+            self.finished_tests = {}
+            self.watchdogs = {}
+        # Ensure that the equipment is connected
+        if connect:
+            self.connect_equipment()
+            if self.equipment_times:
+                self.log(self.get_equipment_report())
+
+    def start_tests(self, test_classes, callback = None):
+        '''Runs the tests (whose prerequisites outside test_classes must 
+        have finished already). Ends the run when they have finished, or
+        calls callback(no_failures) instead (see pipeline).'''
+        with self.lock:
+            # Load the tests to be performed
+            self.pending_tests = [TestClass(self) 
+                                    for TestClass in test_classes]
+            queued_time = time.time()
+            for test in self.pending_tests:
+                test.queued_time = queued_time
+            self.running_tests = []
+            self.tests_callback = callback
+            self.finishing = False
+            self.prerequisites = self.get_registry()[1]
+            # Start every test that has no prerequisites
+            self.start_ready_tests()
+            # Nothing could be started
+            finish = self.claim_finish()
+        if finish:
+            self.tests_finished()
+
+    @staticmethod
+    def get_prerequisites(tests):
+        '''Returns a dictionary of test id to the set of test ids that must
+        finish before that test can start (tests may be the test classes or
+        the tests).'''
+        ids = [test.id for test in tests]
+        prerequisites = {}
+        for (n, test) in enumerate(tests):
+            if test.requires is None:
+                prerequisites[test.id] = set(ids[:n])
+            else:
+                unknown = set(test.requires) - set(ids)
+                assert not unknown, '%s requires unknown tests: %s'%(test.id, 
+                                                    ', '.join(sorted(unknown)))
+                prerequisites[test.id] = set(test.requires)
+        return prerequisites
+
+    def start_ready_tests(self):
+        '''Start every pending test whose prerequisites have finished.
+        Must be called with the lock held.'''
+        for test in list(self.pending_tests):
+            if self.prerequisites[test.id] <= set(self.finished_tests):
+                self.pending_tests.remove(test)
+                self.running_tests.append(test)
+                self.start_watchdog(test)
+                test.start()
+
+    def claim_finish(self):
+        '''Returns True, to only one caller, once nothing is left running so
+        that tests finishing together don't each end the run. Must be called
+        with the lock held.'''
+        if self.running_tests or self.finishing:
+            return False
+        self.finishing = True
+        return True
+
+    def get_deadline(self, test):
+        '''Returns the seconds a test may take before it is failed, or None
+        for no deadline. Set in the configuration's [deadlines] section as
+        <test id> = seconds (0 for no deadline), or else derived from the
+        test's exp_time as exp_time*factor, but no less than minimum.'''
+        if self.config.has_option('deadlines', test.id):
+            return self.config.getfloat('deadlines', test.id) or None
+        exp_time = test.exp_time
+        if exp_time is None:
+            return None
+        factor = self.config.getfloat('deadlines', 'factor', fallback = 10)
+        minimum = self.config.getfloat('deadlines', 'minimum', fallback = 5)
+        return max(exp_time*factor, minimum)
+
+    def start_watchdog(self, test):
+        deadline = self.get_deadline(test)
+        if deadline is None:
+            return
+        test.deadline_time = time.time() + deadline
+        watchdog = threading.Timer(deadline, self.deadline_expired, [test])
+        watchdog.daemon = True
+        self.watchdogs[test.id] = watchdog
+        watchdog.start()
+
+    def deadline_expired(self, test):
+        with self.lock:
+            if test not in self.running_tests:
+                return
+            # Fail the test, then stop the thread from changing the result
+            test.fail('Timed out after %.1fs: %s'%(self.get_deadline(test), 
+                            test.name), exit = test.timeout_exit)
+            test.timed_out = True
+            test.end_time = time.time()
+        # Ask the thread to stop and carry on without it
+        test.cancel()
+        self.test_callback(test)
+
+    def test_callback(self, test):
+        # Pass pending/running state updates straight to the GUI
+        if test.state not in ['pass', 'fail']:
+            self.parent.test_callback(test)
+        else:
+            with self.lock:
+                # Ignore a second result from the same test (a thread 
+                # exception raised after the test had already finished, or
+                # a test that finished after missing its deadline)
+                if test not in self.running_tests:
+                    return
+                self.running_tests.remove(test)
+                watchdog = self.watchdogs.pop(test.id, None)
+                if watchdog is not None:
+                    watchdog.cancel()
+                self.finished_tests[test.id] = test.state
+                if test.state == 'fail':
+                    self.no_failures = False
+            self.parent.test_callback(test)
+            # Log the state and any data
+            log_data = '%s: %s'%(test.state.upper(), test.name)
+            if test.data:
+                log_data += ', data: ' + test.data
+            self.log(log_data)
+            start = test.start_time or time.time()
+            duration = (test.end_time or time.time()) - start
+            queue_wait = start - (test.queued_time or start)
+            self.results.add_step(self.run_id, test.id, test.name, test.state,
+                                start, duration, test.data, queue_wait, 
+                                test.io_time)
+            # Learn how long the step takes (a timeout says nothing useful)
+            if not test.timed_out:
+                self.durations.record(self.param_dict['partnum'], test.id, 
+                                    duration)
+            with self.lock:
+                # Start any tests that were waiting on this one, callback 
+                # when there is nothing left running. Tests still pending at
+                # that point were stopped (or can never have their 
+                # prerequisites met) and are not run.
+                self.start_ready_tests()
+                finish = self.claim_finish()
+            if finish:
+                self.tests_finished()
+
+    def abandon_tests(self, reason):
+        '''Fails the tests that are still running without waiting for them
+        to call back (they may never), and stops the run.'''
+        with self.lock:
+            tests = list(self.running_tests)
+            self.running_tests = []
+            # Their callbacks (if they ever come) can't end the tests again
+            self.finishing = True
+            for test in tests:
+                test.state = 'fail'
+                # Stop the thread from changing the result
+                test.timed_out = True
+                self.finished_tests[test.id] = test.state
+                watchdog = self.watchdogs.pop(test.id, None)
+                if watchdog is not None:
+                    watchdog.cancel()
+        self.stop()
+        for test in tests:
+            test.cancel()
+            self.log('FAIL: %s, %s'%(test.name, reason))
+            self.parent.test_callback(test)
+
+    def tests_finished(self):
+        if self.tests_callback is not None:
+            self.tests_callback(self.no_failures)
+        else:
+            self.end_run()
+
+    def end_run(self):
+        '''Logs the result, closes the log and calls back with the result.'''
+        if self.no_failures:
+            exit_msg = 'PASS: All automated tests passed!'
+        else:
+            exit_msg =  'FAIL: There were automated test failures!'
+        self.log(exit_msg, force_file = True)
+        self.close_log()
+        # Only record the run as ended once its whole log is on the disk
+        log_writer.get_writer().flush()
+        self.results.end_run(self.run_id, 
+                    'pass' if self.no_failures else 'fail',
+                    time.time() - self.start_time, self.log_filename)
+        # Off the critical path: the durations are saved by a timer
+        self.durations.save_later()
+        self.parent.procedure_callback(self.no_failures)
+
+    def update_config(self, config):
+        self.config = config
+        self.bind_equipment()
+
+    def bind_equipment(self):
+        '''Wraps the equipment to time it, and points it at the instrument
+        bound to this fixture (if any) so that fixtures sharing a station
+        don't grab each other's equipment. Done as soon as the fixture's
+        configuration arrives, before anything (a trigger) connects it.'''
+        for (key, equipment) in list(self.equipment.items()):
+            # Count the time spent in equipment calls as test I/O time
+            if not isinstance(equipment, step_timing.TimedEquipment):
+                equipment = step_timing.TimedEquipment(equipment)
+                self.equipment[key] = equipment
+            if self.config.has_option('fixture', key):
+                equipment.address = self.config.get('fixture', key)
+
+    def operator_query(self, request):
+        '''Show the request to the operator and block until it is answered
+        (or times out). Returns the answer.'''
+        with self.lock:
+            self.operator_requests.append(request)
+        try:
+            self.parent.operator_query(request)
+            return request.wait()
+        finally:
+            with self.lock:
+                self.operator_requests.remove(request)
+
+    def manual_failure(self):
+        self.no_failures = False
+        self.log('FAIL: Manual test failure!')
+
+    def thread_exception(self, test, e):
+        print(traceback.format_exc())
+        self.log('-'*71)
+        self.log('Thread Exception in %s!'%test.trans[0])
+        self.log(traceback.format_exc())
+        self.log('-'*71)
+        # Set the state to failed and execute the callback
+        test.state = 'fail'
+        self.stop()
+        self.test_callback(test)
+
+    def wait_for_trigger(self):
+        '''Waits for a poll of the trigger's reader that was in progress
+        when the trigger was disarmed. Called on the test threads so that
+        the GUI doesn't wait for it.'''
+        trigger = self.trigger
+        if trigger is not None:
+            trigger.wait_idle()
+
+    def got_tag(self, tag):
+        self.tag = tag
+
+    def get_expected_time(self):
+        '''Returns the expected seconds for a run: the longest chain of 
+        prerequisites, using the median of the learned step durations (or
+        the test's exp_time until there are some).'''
+        partnum = dict(self.config.items('uservars'))['partnum']
+        durations = step_timing.get_durations()
+        (test_classes, prerequisites) = self.get_registry()
+        finish = {}
+        for (test_id, TestClass) in test_classes.items():
+            expected = durations.percentile(partnum, test_id, 50, 
+                                        TestClass.exp_time or 0)
+            start = max([finish[id] for id in prerequisites[test_id]
+                                    if id in finish] + [0])
+            finish[test_id] = start + expected
+        return max(finish.values()) if finish else 0
+
+    def get_step_stats(self):
+        '''Returns the learned duration percentiles of each step (see 
+        step_timing.StepDurations.stats).'''
+        partnum = dict(self.config.items('uservars'))['partnum']
+        return step_timing.get_durations().stats(partnum)
+
+    def connect_equipment(self):
+        '''Connects every instrument at once, each with its own timeout. Set
+        in the configuration's [equipment] section as timeout = seconds (10
+        by default) or <equipment key> = seconds. Raises EquipmentFailure
+        with every instrument that failed. The seconds each instrument took
+        are left in self.equipment_times.
+
+        Each timeout starts when the instrument's connect does. Waiting for
+        a free worker is limited to the longest timeout. A connect that 
+        timed out can't be interrupted, so the instrument fails straight
+        away on later runs until that connect has finished.'''
+        self.bind_equipment()
+        self.equipment_times = {}
+        if not self.equipment:
+            return
+        default_timeout = self.config.getfloat('equipment', 'timeout', 
+                                                fallback = 10)
+        workers = self.config.getint('equipment', 'workers', fallback = 8)
+        timeouts = dict((key, self.config.getfloat('equipment', key, 
+                                                fallback = default_timeout))
+                        for key in self.equipment)
+        pool = concurrent.futures.ThreadPoolExecutor(
+                                max_workers = min(workers, len(self.equipment)),
+                                thread_name_prefix = 'connect')
+        start = time.time()
+        # Equipment key: when its connect started
+        starts = {}
+        futures = []
+        failures = []
+        for (key, equipment) in self.equipment.items():
+            previous = self.connecting.get(key)
+            if previous is not None and not previous.done():
+                self.equipment_times[key] = 0.0
+                failures.append((equipment, 'Still connecting after an '
+                                                'earlier timeout'))
+                continue
+            started = threading.Event()
+            future = pool.submit(self.connect_instrument, key, equipment, 
+                                    self.equipment_times, starts, started)
+            self.connecting[key] = future
+            futures.append((key, equipment, future, started))
+        queue_timeout = max(timeouts.values())
+        for (key, equipment, future, started) in futures:
+            timeout = timeouts[key]
+            try:
+                if not started.wait(max(0, start + queue_timeout - 
+                                            time.time())):
+                    # Still waiting for a worker, so it can be cancelled
+                    future.cancel()
+                    self.equipment_times[key] = time.time() - start
+                    failures.append((equipment, 'Not started after %.1fs'%(
+                                                            queue_timeout)))
+                    continue
+                future.result(max(0, starts[key] + timeout - time.time()))
+            except concurrent.futures.TimeoutError:
+                self.equipment_times[key] = time.time() - starts[key]
+                failures.append((equipment, 
+                            'No connection after %.1fs'%timeout))
+            except Exception as e:
+                failures.append((equipment, e))
+        # Don't wait on a connect that timed out (it can't be interrupted)
+        pool.shutdown(wait = False)
+        if failures:
+            raise self.EquipmentFailure(failures)
+        self.start_captures()
+
+    def connect_instrument(self, key, equipment, times, starts = None,
+                            started = None):
+        '''Checks (or makes) the connection, recording the time it took in
+        times (and when it started in starts, setting started).'''
+        start = time.time()
+        if started is not None:
+            starts[key] = start
+            started.set()
+        # A poll of the trigger's reader may still be running
+        if self.trigger is not None and self.trigger.key == key:
+            self.trigger.wait_idle()
+        try:
+            # Instrument sessions stay open between runs, so make sure the
+            # instrument is still there (a cheap *IDN? round trip)
+            if equipment.connected and hasattr(equipment, 'get_id'):
+                try:
+                    equipment.get_id()
+                except Exception:
+                    equipment.connected = False
+            if not equipment.connected:
+                equipment.connect()
+                if not equipment.connected:
+                    raise RuntimeError('Not found')
+        finally:
+            times.setdefault(key, time.time() - start)
+
+    def start_captures(self):
+        '''Keeps the barcode readers listed in [barcode] capture scanning in 
+        the background (see BarcodeCapture), so a label can be scanned while
+        the last DUT is still being tested.'''
+        for key in self.config.get('barcode', 'capture', 
+                                    fallback = '').split():
+            equipment = self.equipment[key]
+            if equipment.connected:
+                equipment.start_capture()
+
+    def clear_captures(self):
+        '''Throws away the scans that haven't been taken, so the next DUT
+        doesn't get an old label.'''
+        for equipment in self.equipment.values():
+            capture = getattr(equipment, 'capture', None)
+            if capture is not None:
+                capture.clear()
+
+    def get_equipment_report(self):
+        '''Returns a line with the time each instrument took to connect,
+        slowest first.'''
+        times = sorted(self.equipment_times.items(), key = lambda kv: -kv[1])
+        return 'Equipment: ' + ', '.join('%s %.2fs'%kv for kv in times)
+
+    def disconnect_equipment(self):
+        for equipment in self.equipment.values():
+            try:
+                equipment.disconnect()
+            except Exception as e:
+                print(e)
+
+    def log(self, log_data, force_file = False):
+        with self.lock:
+            self._log(log_data, force_file)
+
+    def _log(self, log_data, force_file = False):
+        time_delta = time.time() - self.start_time
+        self.test_log_buffer.append('%07.03f '%time_delta + log_data + '\n')
+        # Write the buffer to the file if we have a uid, or if we force 
+        # the file (so that we can log failed uid scans)
+        if self.uid != '' or force_file:
+            if self.uid != self.stored_uid:
+                self.results.set_uid(self.run_id, self.uid)
+                self.stored_uid = self.uid
+            dir = 'logs/%s_logs/'%self.param_dict['partnum']
+            log_filename = dir + '%s_%s.log'%(self.uid, self.log_time_str)
+            if log_filename != self.log_filename:
+                self.close_log()
+                self.log_filename = log_filename
+                log_writer.get_writer().open(self.log_filename,
+                                    flush = self.log_flush,
+                                    fsync = self.log_fsync)
+            # The writer thread does the file I/O so the tests don't wait
+            log_writer.get_writer().write(self.log_filename, 
+                                    ''.join(self.test_log_buffer))
+            # Clear the log buffer since we just handed it to the writer
+            self.test_log_buffer = []
+
+    def close_log(self):
+        if self.log_filename is not None:
+            log_writer.get_writer().close(self.log_filename)
+
+    def stop(self):
+        with self.lock:
+            # A stop is a forced failure
+            self.no_failures = False
+            self.stopped = True
+            # Finish whatever tests are running, then exit on the callback
+            self.pending_tests = []
+            requests = list(self.operator_requests)
+        # Don't leave a test waiting on an operator after a stop
+        for request in requests:
+            request.cancel()
+
+    def end(self):
+        # Stop the barcode readers capturing (which throws away the scans)
+        for equipment in self.equipment.values():
+            if getattr(equipment, 'capture', None) is not None:
+                equipment.stop_capture()
+
+    class EquipmentFailure(Exception):
+        def __init__(self, failures):
+            # [(equipment, exception or message)] for every instrument that
+            # failed to connect
+            self.failures = failures
+            self.name = ', '.join(equipment.name for (equipment, e) 
+                                                        in failures)
+            self.message = '\n\t'.join('%s: %s'%(equipment.name, e) 
+                                        for (equipment, e) in failures)
+
+        def __str__(self):
+            return self.message
@@ -0,0 +1,105 @@
+# coding: utf-8
+import procedure_base
+from procedure_base import TestThread
+from pipeline import Stage
+from equipment import Keithley2200, Keithley2110, RigolDSA815
+from equipment.Keithley2110 import burst_stats
+
+# Exercises the power supply, multimeter and spectrum analyzer drivers the
+# way a commissioning procedure uses them, so that benchmark.py (with the
+# simulated instruments) measures the instrument I/O and not just sleeps.
+
+title = 'Instrument Test 1.0'
+
+class Verify(TestThread):
+    id = 'verify'
+    trans = ('Verify Fixture','夹具检验')
+
+    def test_procedure(self):
+        power = self.parent.equipment['power']
+        power.set_voltage(3.0, 0.5)
+        power.enable()
+        power.wait_settled(sleep = self.sleep)
+        power.disable()
+        self.message = 'Instrument Test Fixture PASS'
+        self.state = 'pass'
+
+class PowerOn(TestThread):
+    id = 'poweron'
+    trans = ('Power On','上电')
+    exp_time = 0.1
+    # Volts
+    voltage = 3.0
+
+    def test_procedure(self):
+        power = self.parent.equipment['power']
+        power.set_voltage(self.voltage, 0.5)
+        power.enable()
+        (voltage, current) = power.wait_settled(sleep = self.sleep)
+        self.data = '%.3fV %.4fA'%(voltage, current)
+        if abs(voltage - self.voltage) > 0.05*self.voltage:
+            self.fail('Supply voltage %.3fV'%voltage)
+        self.state = 'pass'
+
+class SupplyCurrent(TestThread):
+    id = 'current'
+    trans = ('Supply Current','电源电流')
+    exp_time = 0.1
+    # Amps
+    limits = (0.005, 0.020)
+    samples = 50
+
+    def test_procedure(self):
+        dmm = self.parent.equipment['dmm']
+        dmm.setup_current_read()
+        (samples, period) = dmm.read_current_burst(self.samples)
+        stats = burst_stats(samples, period)
+        self.data = '%.4fA (std %.5fA)'%(stats['mean'], stats['std'])
+        if not self.limits[0] <= stats['mean'] <= self.limits[1]:
+            self.fail('Supply current %.4fA'%stats['mean'])
+        self.state = 'pass'
+
+class Carrier(TestThread):
+    id = 'carrier'
+    trans = ('Carrier','载波')
+    exp_time = 0.1
+    # dBm
+    min_power = -30.0
+    # Hz
+    frequency = 433164000
+    tolerance = 20000
+
+    def test_procedure(self):
+        (power, freq) = self.parent.equipment['analyzer'].get_carrier_stats()
+        self.data = '%.1fdBm %dHz'%(power, freq)
+        if power < self.min_power:
+            self.fail('Carrier power %.1fdBm'%power)
+        if abs(freq - self.frequency) > self.tolerance:
+            self.fail('Carrier frequency %dHz'%freq)
+        self.state = 'pass'
+
+class PowerOff(TestThread):
+    id = 'poweroff'
+    trans = ('Power Off','断电')
+    exp_time = 0.1
+
+    def test_procedure(self):
+        self.parent.equipment['power'].disable()
+        self.state = 'pass'
+
+class Procedure(procedure_base.Procedure):
+    title = title
+    verify_class = Verify
+    # The tests in the order they are listed
+    test_classes = [PowerOn,
+                    SupplyCurrent,
+                    Carrier,
+                    PowerOff]
+    # The DUT stays powered for all of the tests, so there is one stage
+    stages = [Stage('test', ['power', 'dmm', 'analyzer'])]
+
+    def __init__(self, parent, config):
+        super(Procedure, self).__init__(parent, config)
+        self.equipment = {'power': Keithley2200.PowerSupply(),
+                          'dmm': Keithley2110.Multimeter(),
+                          'analyzer': RigolDSA815.SpectrumAnalyzer()}
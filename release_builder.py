@@ -41,9 +41,13 @@ def build_release_file(version_string):
     lines.append("sys.path.insert(0, './equipment')")
 
     # Add the imports for the built in procedures because pyinstaller does not
-    # detect them when they're imported at runtime
+    # detect them when they're imported at runtime. They are in a function
+    # (which pyinstaller still follows) so that importing release doesn't 
+    # load every procedure and its equipment at startup.
+    lines.append('def import_procedures():')
     for file in glob('procedures/*.py'):
-        lines.append('import procedures.%s'%pathlib.Path(file).stem)
+        lines.append('    import procedures.%s'%pathlib.Path(file).stem)
+    lines.append('    pass')
 
     # Add the version string
     lines.append("version = '%s'"%parse_version_tag(version_string))
@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import atexit
+import sqlite3
+import argparse
+import threading
+import queue as Queue
+import error_log
+
+default_database = 'logs/results.db'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    partnum TEXT,
+    uid TEXT,
+    fixture TEXT,
+    title TEXT,
+    version TEXT,
+    start REAL,
+    duration REAL,
+    result TEXT,
+    log_filename TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id TEXT,
+    step_id TEXT,
+    name TEXT,
+    state TEXT,
+    start REAL,
+    duration REAL,
+    data TEXT,
+    queue_wait REAL,
+    io_time REAL
+);
+CREATE INDEX IF NOT EXISTS runs_partnum ON runs (partnum, start);
+CREATE INDEX IF NOT EXISTS runs_uid ON runs (uid, start);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+CREATE INDEX IF NOT EXISTS steps_run ON steps (run_id);
+'''
+
+class ResultsStore(object):
+    '''Structured record of every run and step in a SQLite database.
+    Writes are queued and committed in batches by a background thread so
+    that the test threads never wait on the database.'''
+    def __init__(self, filename = default_database):
+        self.filename = filename
+        dir = os.path.dirname(filename)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target = self.run,
+                                        name = 'ResultsStore')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def connect(self):
+        conn = sqlite3.connect(self.filename)
+        # WAL lets the query tools read while the station is writing
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(schema)
+        # Add the columns that databases from older versions are missing
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(steps)')]
+        for column in ['queue_wait', 'io_time']:
+            if column not in columns:
+                conn.execute('ALTER TABLE steps ADD COLUMN %s REAL'%column)
+        return conn
+
+    def run(self):
+        conn = self.connect()
+        while True:
+            # Block until there is something to do, then commit everything
+            # else that has been queued in the meantime in one transaction
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            waiting = []
+            try:
+                with conn:
+                    for (sql, params) in batch:
+                        if sql is None:
+                            waiting.append(params)
+                        else:
+                            conn.execute(sql, params)
+            except Exception:
+                error_log.write_error()
+            for done in waiting:
+                done.set()
+
+    def execute(self, sql, params = ()):
+        self.queue.put((sql, params))
+
+    def flush(self, timeout = 5):
+        '''Block until everything queued so far has been committed.'''
+        done = threading.Event()
+        self.queue.put((None, done))
+        return done.wait(timeout)
+
+    def start_run(self, run_id, partnum, fixture, title, version, start):
+        self.execute('INSERT INTO runs (run_id, partnum, fixture, title, '
+                    'version, start) VALUES (?, ?, ?, ?, ?, ?)',
+                    (run_id, partnum, fixture, title, version, start))
+
+    def set_uid(self, run_id, uid):
+        self.execute('UPDATE runs SET uid = ? WHERE run_id = ?', (uid, run_id))
+
+    def add_step(self, run_id, step_id, name, state, start, duration, data,
+                    queue_wait = None, io_time = None):
+        self.execute('INSERT INTO steps (run_id, step_id, name, state, start, '
+                    'duration, data, queue_wait, io_time) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (run_id, step_id, name, state, start, duration, data,
+                    queue_wait, io_time))
+
+    def end_run(self, run_id, result, duration, log_filename):
+        self.execute('UPDATE runs SET result = ?, duration = ?, '
+                    'log_filename = ? WHERE run_id = ?',
+                    (result, duration, log_filename, run_id))
+
+def query_runs(conn, uid = None, partnum = None, since = None, until = None):
+    '''Returns the runs (as sqlite3.Row) matching all of the given filters,
+    oldest first.'''
+    where = []
+    params = []
+    for (column, op, value) in [('uid', '=', uid),
+                                ('partnum', '=', partnum),
+                                ('start', '>=', since),
+                                ('start', '<', until)]:
+        if value is not None:
+            where.append('%s %s ?'%(column, op))
+            params.append(value)
+    sql = 'SELECT * FROM runs'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return conn.execute(sql + ' ORDER BY start', params).fetchall()
+
+def query_steps(conn, run_id):
+    return conn.execute('SELECT * FROM steps WHERE run_id = ? ORDER BY start',
+                        (run_id,)).fetchall()
+
+def query_yield(conn, partnum = None, since = None, until = None):
+    '''Returns a list of (partnum, runs, passed) for finished runs.'''
+    runs = query_runs(conn, partnum = partnum, since = since, until = until)
+    counts = {}
+    for run in runs:
+        if run['result'] is None:
+            continue
+        (total, passed) = counts.get(run['partnum'], (0, 0))
+        counts[run['partnum']] = (total + 1,
+                                passed + (run['result'] == 'pass'))
+    return [(k, total, passed) for (k, (total, passed))
+                                            in sorted(counts.items())]
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store(filename = default_database):
+    '''Returns the results store shared by every procedure in the program.'''
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ResultsStore(filename)
+        return _store
+
+def parse_date(date_str):
+    return time.mktime(time.strptime(date_str, '%Y-%m-%d'))
+
+def parse_end_date(date_str):
+    '''The end of the day (midnight after it), so --until includes it.'''
+    day = time.strptime(date_str, '%Y-%m-%d')
+    # mktime rolls the 32nd over into the next month (and knows about DST)
+    return time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 
+                        0, 0, 0, 0, 0, -1))
+
+def format_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Query test results')
+    parser.add_argument('--db', default = default_database)
+    sub = parser.add_subparsers(dest = 'command', required = True)
+    runs_parser = sub.add_parser('runs', help = 'list runs and their steps')
+    runs_parser.add_argument('--uid')
+    runs_parser.add_argument('--partnum')
+    runs_parser.add_argument('--steps', action = 'store_true',
+                            help = 'also list the steps of each run')
+    yield_parser = sub.add_parser('yield', help = 'pass rate per part number')
+    yield_parser.add_argument('--partnum')
+    for p in [runs_parser, yield_parser]:
+        p.add_argument('--since', type = parse_date, help = 'YYYY-MM-DD')
+        p.add_argument('--until', type = parse_end_date, 
+                        help = 'YYYY-MM-DD (inclusive)')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect('file:%s?mode=ro'%args.db, uri = True)
+    conn.row_factory = sqlite3.Row
+    if args.command == 'runs':
+        for run in query_runs(conn, args.uid, args.partnum,
+                                args.since, args.until):
+            print('%s  %-12s %-20s %-5s %6.1fs  %s'%(format_time(run['start']),
+                    run['partnum'], run['uid'] or '-', run['result'] or '-',
+                    run['duration'] or 0, run['log_filename'] or ''))
+            if args.steps:
+                for step in query_steps(conn, run['run_id']):
+                    print('    %-5s %6.2fs (queued %5.2fs, i/o %5.2fs)  %s  %s'%(
+                            step['state'], step['duration'] or 0,
+                            step['queue_wait'] or 0, step['io_time'] or 0,
+                            step['name'], step['data'] or ''))
+    else:
+        for (partnum, total, passed) in query_yield(conn, args.partnum,
+                                                args.since, args.until):
+            print('%-20s %5d runs  %5d passed  %6.2f%%'%(partnum, total,
+                                            passed, 100.0*passed/total))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
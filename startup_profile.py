@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# Startup timeline for CommissioningStation.py --profile-startup: how long
+# each module took to import and each stage of building the window took,
+# nested the way they happened, written to a text file once the window has
+# been shown.
+#
+#   python CommissioningStation.py --profile-startup
+#   python CommissioningStation.py --profile-startup=startup.txt --lazy
+
+default_filename = 'logs/startup_profile.txt'
+
+_start = time.perf_counter()
+_enabled = False
+_lock = threading.Lock()
+# (start, duration, self time, depth, label) in seconds since _start
+_events = []
+# Time spent in the children of each open event of the main thread
+_stack = []
+
+def enabled():
+    return _enabled
+
+def enable():
+    '''Start timing imports (call as early as possible).'''
+    global _enabled
+    with _lock:
+        if not _enabled:
+            _enabled = True
+            sys.meta_path.insert(0, ImportTimer())
+
+@contextmanager
+def stage(label):
+    '''Times the block as one stage of the startup.'''
+    if not _enabled or threading.current_thread() is not \
+                                            threading.main_thread():
+        yield
+        return
+    _stack.append(0.0)
+    depth = len(_stack) - 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += duration
+        _events.append((start - _start, duration, duration - children,
+                        depth, label))
+
+def mark(label):
+    '''Records a point in the startup (e.g. the window being shown).'''
+    if _enabled:
+        _events.append((time.perf_counter() - _start, 0.0, 0.0, len(_stack),
+                        label))
+
+class TimedLoader(object):
+    '''Wraps a module's loader while the module is executed.'''
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        try:
+            with stage('import %s'%module.__name__):
+                self.loader.exec_module(module)
+        finally:
+            # Put the real loader back for anything that inspects it later
+            module.__loader__ = self.loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self.loader
+
+class ImportTimer(object):
+    '''Meta path finder that finds modules through the other finders and
+    times their execution.'''
+    def find_spec(self, name, path, target = None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader,
+                                                    'exec_module'):
+                spec.loader = TimedLoader(spec.loader)
+            return spec
+        return None
+
+def write_report(filename = default_filename, slowest = 15):
+    '''Writes the timeline (and the slowest steps by their own time) to
+    filename.'''
+    events = sorted(_events)
+    lines = ['Startup timeline (ms since start, total ms, own ms)', '']
+    for (start, duration, own, depth, label) in events:
+        lines.append('%8.1f %8.1f %8.1f  %s%s'%(1000*start, 1000*duration,
+                                        1000*own, '  '*depth, label))
+    lines += ['', 'Slowest by own time', '']
+    for (start, duration, own, depth, label) in sorted(events,
+                                key = lambda e: -e[2])[:slowest]:
+        lines.append('%8.1f  %s'%(1000*own, label))
+    dir = os.path.dirname(filename)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    with open(filename, 'w') as ofile:
+        ofile.write('\n'.join(lines) + '\n')
+
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import atexit
+import threading
+import error_log
+
+default_filename = 'logs/step_durations.json'
+
+def percentile(values, pct):
+    '''Linear interpolation between the closest ranks.'''
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    pos = (len(values) - 1)*pct/100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo])*(pos - lo)
+
+class TimedEquipment(object):
+    '''Wraps a piece of equipment so that the time spent in each of its
+    methods is added to the io_time of the calling test thread.'''
+    def __init__(self, equipment):
+        object.__setattr__(self, 'equipment', equipment)
+
+    def __getattr__(self, name):
+        attr = getattr(self.equipment, name)
+        if not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                thread = threading.current_thread()
+                if hasattr(thread, 'io_time'):
+                    thread.io_time += time.time() - start
+        return timed
+
+    def __setattr__(self, name, value):
+        setattr(self.equipment, name, value)
+
+class StepDurations(object):
+    '''Rolling window of the most recent durations of each step of each
+    part number, kept on disk so that the expected times survive a
+    restart.'''
+    def __init__(self, filename = default_filename, window = 200):
+        # Absolute, so that a save from the timer (or at exit) goes to the 
+        # same file whatever the working directory is by then
+        self.filename = os.path.abspath(filename)
+        self.window = window
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # The timer of a save_later() that hasn't saved yet
+        self.save_timer = None
+        # Save anything still waiting for the timer when the program exits
+        atexit.register(self.flush)
+        try:
+            with open(filename) as ifile:
+                self.durations = json.load(ifile)
+        except (IOError, ValueError):
+            self.durations = {}
+
+    def record(self, partnum, step_id, seconds):
+        with self.lock:
+            steps = self.durations.setdefault(partnum, {})
+            values = steps.setdefault(step_id, [])
+            values.append(seconds)
+            del values[:-self.window]
+
+    def get(self, partnum, step_id):
+        with self.lock:
+            return list(self.durations.get(partnum, {}).get(step_id, []))
+
+    def percentile(self, partnum, step_id, pct, default = None):
+        values = self.get(partnum, step_id)
+        if not values:
+            return default
+        return percentile(values, pct)
+
+    def stats(self, partnum):
+        '''Returns {step id: {'n', 'p50', 'p90', 'p99', 'max'}} in seconds.'''
+        with self.lock:
+            steps = dict(self.durations.get(partnum, {}))
+        stats = {}
+        for (step_id, values) in steps.items():
+            stats[step_id] = {'n': len(values), 'max': max(values)}
+            for pct in [50, 90, 99]:
+                stats[step_id]['p%d'%pct] = percentile(values, pct)
+        return stats
+
+    def save_later(self, delay = 5.0):
+        '''Saves from a timer thread after delay seconds, so that the runs
+        don't wait on the disk. Saves asked for in the meantime are done by
+        the same save.'''
+        with self.lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = threading.Timer(delay, self.timer_save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def timer_save(self):
+        with self.lock:
+            self.save_timer = None
+        try:
+            self.save()
+        except Exception:
+            error_log.write_error()
+
+    def flush(self):
+        '''Saves now if a save_later() is waiting.'''
+        with self.lock:
+            timer = self.save_timer
+            self.save_timer = None
+        if timer is not None:
+            timer.cancel()
+            self.save()
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.durations)
+        dir = os.path.dirname(self.filename)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+        # Write a new file and swap it in so a crash can't leave half a file
+        tmp_filename = self.filename + '.tmp'
+        with self.save_lock:
+            with open(tmp_filename, 'w') as ofile:
+                ofile.write(data)
+            os.replace(tmp_filename, self.filename)
+
+_durations = None
+_durations_lock = threading.Lock()
+
+def get_durations(filename = default_filename):
+    '''Returns the step durations shared by every procedure in the
+    program.'''
+    global _durations
+    with _durations_lock:
+        if _durations is None:
+            _durations = StepDurations(filename)
+        return _durations
@@ -0,0 +1,65 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+import configparser
+
+import procedure_base
+from benchmark import HeadlessStation
+
+class Together(procedure_base.TestThread):
+    # Set by the test so that both tests finish at the same moment
+    barrier = None
+    requires = ()
+
+    def test_procedure(self):
+        self.barrier.wait(5)
+        self.state = 'pass'
+
+class First(Together):
+    id = 'first'
+    trans = ('First', 'First')
+
+class Second(Together):
+    id = 'second'
+    trans = ('Second', 'Second')
+
+class RaceProcedure(procedure_base.Procedure):
+    title = 'Race'
+    test_classes = [First, Second]
+
+class CountingStation(HeadlessStation):
+    def __init__(self):
+        super(CountingStation, self).__init__()
+        self.callbacks = 0
+
+    def procedure_callback(self, noFailures):
+        self.callbacks += 1
+        super(CountingStation, self).procedure_callback(noFailures)
+
+class TestsFinished(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix = 'procedure_base_'))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_tests_finishing_together_end_the_run_once(self):
+        config = configparser.ConfigParser()
+        config.add_section('uservars')
+        config.set('uservars', 'partnum', 'race')
+        for n in range(20):
+            Together.barrier = threading.Barrier(2)
+            station = CountingStation()
+            procedure = RaceProcedure(station, config)
+            procedure.test_start()
+            self.assertTrue(station.done.wait(10))
+            # Give a second (wrong) end of the run time to arrive
+            time.sleep(0.05)
+            self.assertEqual(station.callbacks, 1)
+            self.assertTrue(station.no_failures)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+import time
+import threading
+import error_log
+
+# Starts a test automatically when a DUT is put in the fixture, instead of
+# the operator clicking the Commission button. A trigger watches its source
+# from a background thread while it is armed, and fires once per DUT: the
+# source has to report the DUT for the debounce time, then the trigger waits
+# for the settle time (hands out of the fixture, lid latched) before firing.
+# It is disarmed while the test runs and re-armed after the result, and then
+# waits for the DUT to be removed before looking for the next one.
+#
+# Configured per part number in the [trigger] section:
+#
+#   [trigger]
+#   # tag (a new RFID tag in the field), barcode (a scan, which keeps the 
+#   # reader capturing for the whole job) or switch
+#   source = tag
+#   # Key of the reader (or switch) in the procedure's equipment
+#   equipment = rfid
+#   # switch only: method of the equipment that returns True when closed
+#   method = lid_closed
+#   # Seconds the DUT must be seen for, and seconds to wait before starting
+#   debounce = 0.1
+#   settle = 0.5
+
+class Trigger(object):
+    '''Base class of the trigger sources, which override poll().'''
+    # Whether the source sees a DUT sitting in the fixture (and so must see
+    # it removed before the next one), rather than a one-off event
+    presence = True
+
+    def __init__(self, equipment = None, settle = 0.5, debounce = 0.1,
+                    poll_interval = 0.05, can_connect = True):
+        self.equipment = equipment
+        # Whether the trigger may connect the equipment itself, or must 
+        # wait for the procedure to
+        self.can_connect = can_connect
+        self.settle = settle
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # The value that fired the trigger (EPC, barcode or True)
+        self.value = None
+        self.callback = None
+        self.thread = None
+        self.lock = threading.Lock()
+        # Held while the source is polled, so that wait_idle() can wait for
+        # a poll in progress to finish before the test uses the reader
+        self.poll_lock = threading.Lock()
+        # Key of the equipment in the procedure's equipment (set by 
+        # make_trigger), and the lock that a pipeline's stages hold while
+        # they use that equipment, if any (see pipeline)
+        self.key = None
+        self.resource_lock = None
+        self.armed = threading.Event()
+        self.stopped = threading.Event()
+        self.removal_pending = False
+
+    def poll(self):
+        '''Returns a true value (the EPC, barcode...) while a DUT is there,
+        or None.'''
+        raise NotImplementedError()
+
+    def start(self, callback):
+        '''Start watching, calling callback(trigger) from the trigger's
+        thread each time it fires.'''
+        self.callback = callback
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.run,
+                                        name = 'Trigger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        # Wake the thread if it is waiting to be armed
+        self.armed.set()
+
+    # Thread safe
+    def arm(self):
+        '''Fire for the next DUT (once the current one has been removed).'''
+        with self.lock:
+            self.removal_pending = self.presence
+            self.armed.set()
+
+    # Thread safe
+    def disarm(self):
+        '''Stop watching. A poll that is in progress still finishes (see 
+        wait_idle), so this never blocks the GUI.'''
+        with self.lock:
+            self.armed.clear()
+
+    # Thread safe
+    def wait_idle(self):
+        '''Returns once the source is not being polled, which after disarm()
+        it won't be again until arm() (the readers can't be used by two 
+        threads at once). Called from the test threads.'''
+        with self.poll_lock:
+            pass
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.armed.wait()
+            if self.stopped.is_set():
+                break
+            if self.removal_pending:
+                if self.wait_for(False) is not None:
+                    self.removal_pending = False
+                continue
+            value = self.wait_for(True)
+            if value is None:
+                continue
+            # Let the DUT settle, and make sure it's still there
+            if self.stopped.wait(self.settle):
+                break
+            if self.presence and not self.safe_poll():
+                continue
+            with self.lock:
+                if not self.armed.is_set():
+                    continue
+                self.armed.clear()
+            self.value = value
+            self.callback(self)
+
+    def wait_for(self, present):
+        '''Polls until the DUT has been present (or absent) for the debounce
+        time, returning the polled value (True for absent), or None when
+        disarmed or stopped first.'''
+        since = None
+        while self.armed.is_set() and not self.stopped.is_set():
+            value = self.safe_poll()
+            if bool(value) == present:
+                now = time.time()
+                if since is None:
+                    since = now
+                if now - since >= self.debounce:
+                    return value if present else True
+            else:
+                since = None
+            self.stopped.wait(self.poll_interval)
+        return None
+
+    def safe_poll(self):
+        with self.poll_lock:
+            # Disarmed since deciding to poll
+            if not self.armed.is_set():
+                return None
+            # Wait for a pipeline stage that is using the reader
+            resource_lock = self.resource_lock
+            if resource_lock is not None:
+                while not resource_lock.acquire(timeout = self.poll_interval):
+                    if not self.armed.is_set() or self.stopped.is_set():
+                        return None
+            try:
+                if self.equipment is not None and \
+                                            not self.equipment.connected:
+                    if not self.can_connect:
+                        return None
+                    self.equipment.connect()
+                return self.poll()
+            except Exception:
+                error_log.write_error()
+            finally:
+                if resource_lock is not None:
+                    resource_lock.release()
+        # Keep watching (the reader may be back after a replug), but don't
+        # spin on the error
+        self.stopped.wait(1)
+        return None
+
+class TagArrival(Trigger):
+    '''Fires when an RFID tag comes into the reader's field.'''
+    def __init__(self, reader, poll_ms = 100, **kwargs):
+        Trigger.__init__(self, reader, **kwargs)
+        self.poll_ms = poll_ms
+
+    def poll(self):
+        # Returns as soon as one tag is seen
+        tags = self.equipment.find_tags(self.poll_ms, expected = 1)
+        return tags[0] if tags else None
+
+class Barcode(Trigger):
+    '''Fires when a barcode is scanned.'''
+    presence = False
+
+    def __init__(self, reader, **kwargs):
+        kwargs.setdefault('debounce', 0)
+        Trigger.__init__(self, reader, **kwargs)
+
+    def run(self):
+        try:
+            Trigger.run(self)
+        finally:
+            # The job has ended: stop capturing (which throws away the scans)
+            if getattr(self.equipment, 'capture', None) is not None:
+                self.equipment.stop_capture()
+
+    def poll(self):
+        # Keep the reader capturing (see BarcodeCapture), so that a label 
+        # scanned while the last DUT is still being tested is queued for
+        # the next one
+        if hasattr(self.equipment, 'start_capture'):
+            self.equipment.start_capture()
+        data = self.equipment.scan_barcode(timeout = 0.5)
+        if isinstance(data, bytes):
+            data = data.decode('latin-1')
+        return data.strip() or None
+
+class Switch(Trigger):
+    '''Fires when a fixture switch (lid or nest sensor) closes. read_state
+    returns True while the switch is closed.'''
+    def __init__(self, read_state, equipment = None, **kwargs):
+        Trigger.__init__(self, equipment, **kwargs)
+        self.read_state = read_state
+
+    def poll(self):
+        return True if self.read_state() else None
+
+def make_trigger(config, equipment):
+    '''Returns the trigger described by the config's [trigger] section,
+    using the procedure's equipment dictionary, or None.'''
+    if not config.has_section('trigger'):
+        return None
+    source = config.get('trigger', 'source')
+    options = {'settle': config.getfloat('trigger', 'settle', fallback = 0.5),
+            'debounce': config.getfloat('trigger', 'debounce',
+                                        fallback = 0.1)}
+    key = config.get('trigger', 'equipment')
+    device = equipment[key]
+    # On a station with several fixtures the reader may only be connected
+    # here when it is bound to this fixture (it could claim another 
+    # fixture's reader otherwise). Unbound, it's used once the first run
+    # has connected it.
+    fixtures = config.getint('fixture', 'fixtures', fallback = 1)
+    options['can_connect'] = fixtures == 1 or \
+                                config.has_option('fixture', key)
+    if source == 'tag':
+        trigger = TagArrival(device, **options)
+    elif source == 'barcode':
+        del options['debounce']
+        trigger = Barcode(device, **options)
+    elif source == 'switch':
+        method = getattr(device, config.get('trigger', 'method'))
+        trigger = Switch(method, device, **options)
+    else:
+        raise ValueError('Unknown trigger source: %s'%source)
+    trigger.key = key
+    return trigger